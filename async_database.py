@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial, wraps
+from typing import Callable, Dict, List
+
+import database
+from cache import PhoneNumberProfile, UserProfile, known_users, profile_cache
+from database import config
+from metrics import metrics
+from points import pickup_points
+from tracing import span
+
+
+class DatabaseExecutor:
+    """Runs synchronous Pony ORM calls on a bounded thread pool, so they do not stall the event loop"""
+
+    def __init__(self, max_workers: int = 8, slow_query_threshold: float = 0.5):
+        self.max_workers = max_workers
+        self.slow_query_threshold = slow_query_threshold
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='database')
+        self._lock = threading.Lock()
+        self._submitted = 0
+        self._running = 0
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def queue_depth(self) -> int:
+        return max(self._submitted - self._running, 0)
+
+    @property
+    def in_flight(self) -> int:
+        return self._running
+
+    def _call(self, func: Callable, timings: list, *args, **kwargs):
+        with self._lock:
+            self._running += 1
+
+        timings.append(time.perf_counter())
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings.append(time.perf_counter())
+            with self._lock:
+                self._running -= 1
+
+    async def run(self, func: Callable, *args, **kwargs):
+        name = func.__name__
+        timings = [time.perf_counter()]
+        failed = False
+        self._submitted += 1
+
+        try:
+            with span(f'database {name}'):
+                return await asyncio.get_running_loop().run_in_executor(
+                    self._pool, partial(self._call, func, timings, *args, **kwargs))
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._submitted -= 1
+            if len(timings) == 3:
+                self._record(name, wait=timings[1] - timings[0], duration=timings[2] - timings[1], failed=failed)
+
+    def _record(self, name: str, wait: float, duration: float, failed: bool):
+        metrics.observe('database_call_duration_seconds', wait + duration, function=name)
+        stats = self._stats.setdefault(name, {'calls': 0, 'errors': 0, 'wait': 0.0, 'time': 0.0, 'max_time': 0.0})
+        stats['calls'] += 1
+        stats['errors'] += failed
+        stats['wait'] += wait
+        stats['time'] += duration
+        stats['max_time'] = max(stats['max_time'], duration)
+
+        if wait + duration > self.slow_query_threshold:
+            self._log.warning(f'slow database call {name}: waited {wait:.3f}s in queue, ran {duration:.3f}s '
+                              f'(queue depth {self.queue_depth}, in flight {self.in_flight})')
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'max_workers': self.max_workers,
+            'functions': {name: {**stats,
+                                 'avg_wait': stats['wait'] / stats['calls'],
+                                 'avg_time': stats['time'] / stats['calls']}
+                          for name, stats in self._stats.items()},
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
+
+
+executor = DatabaseExecutor(**config.get('database_executor', {}))
+
+
+def _awaitable(func: Callable) -> Callable:
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await executor.run(func, *args, **kwargs)
+
+    return wrapper
+
+
+add_parcel = _awaitable(database.add_parcel)
+add_parcels = _awaitable(database.add_parcels)
+phone_number_exists = _awaitable(database.phone_number_exists)
+get_phone_number_owner = _awaitable(database.get_phone_number_owner)
+get_user_last_parcel_with_shipment_number = _awaitable(database.get_user_last_parcel_with_shipment_number)
+get_latest_parcel_statuses = _awaitable(database.get_latest_parcel_statuses)
+get_notification_accounts = _awaitable(database.get_notification_accounts)
+get_qr_code_media = _awaitable(database.get_qr_code_media)
+set_qr_code_media = _awaitable(database.set_qr_code_media)
+delete_qr_code_media = _awaitable(database.delete_qr_code_media)
+user_is_phone_number_owner = _awaitable(database.user_is_phone_number_owner)
+get_dict = _awaitable(database.get_dict)
+get_me = _awaitable(database.get_me)
+get_inpost_obj = _awaitable(database.get_inpost_obj)
+compact_parcel_data = _awaitable(database.compact_parcel_data)
+heartbeat_worker = _awaitable(database.heartbeat_worker)
+rebalance_shard_leases = _awaitable(database.rebalance_shard_leases)
+release_shard_leases = _awaitable(database.release_shard_leases)
+get_shard_report = _awaitable(database.get_shard_report)
+_get_user_ids = _awaitable(database.get_user_ids)
+_get_pickup_points = _awaitable(database.get_pickup_points)
+_get_user_profile = _awaitable(database.get_user_profile)
+_set_user_consent = _awaitable(database.set_user_consent)
+_add_user = _awaitable(database.add_user)
+_add_phone_number_config = _awaitable(database.add_phone_number_config)
+_update_user_location = _awaitable(database.update_user_location)
+_edit_default_phone_number = _awaitable(database.edit_default_phone_number)
+_edit_default_parcel_machine = _awaitable(database.edit_default_parcel_machine)
+_edit_phone_number_config = _awaitable(database.edit_phone_number_config)
+_delete_user = _awaitable(database.delete_user)
+
+
+async def get_user_profile(userid: int) -> UserProfile | None:
+    """Settings of user, read from database only when they are not cached yet"""
+    if (profile := profile_cache.get(userid)) is not None:
+        return profile
+
+    writes = profile_cache.writes
+    if (row := await _get_user_profile(userid=userid)) is None:
+        return None
+
+    profile = UserProfile(**row)
+    profile_cache.put(profile, writes=writes)
+    return profile
+
+
+async def load_known_users(batch_size: int = 10000, retry_interval: float = 30):
+    """Warms known users index, reads user ids in batches, so no executor worker is held for long"""
+    while True:
+        try:
+            userids, after = array('q'), 0
+            while batch := await _get_user_ids(after=after, batch_size=batch_size):
+                userids.extend(batch)
+                after = batch[-1]
+
+            known_users.load(userids)
+            return
+        except Exception as e:  # until index is loaded every lookup falls back to database, so keep trying
+            logging.getLogger(__name__).exception(f'loading known users failed, retrying in {retry_interval}s: {e}')
+            await asyncio.sleep(retry_interval)
+
+
+async def load_pickup_points():
+    """Restores pickup point catalogue saved by previous run, first start builds it up from stored parcels.
+
+    Import file is applied last, so corrected coordinates it brings are not overwritten by saved ones."""
+    if not pickup_points.restore() and pickup_points.scan_database:
+        await _scan_pickup_points()
+
+    if pickup_points.import_file:
+        imported = pickup_points.import_points(pickup_points.import_file)
+        logging.getLogger(__name__).info(f'imported {imported} pickup points')
+        pickup_points.save()
+
+
+async def _scan_pickup_points():
+    try:
+        after = 0
+        while True:
+            last, points = await _get_pickup_points(after=after, batch_size=pickup_points.scan_batch_size)
+            if last == after:
+                break
+
+            pickup_points.add_many(points)
+            after = last
+    except Exception as e:  # catalogue still grows from parcels users list
+        logging.getLogger(__name__).exception(f'building pickup point catalogue failed: {e}')
+        return
+
+    pickup_points.save()
+
+
+async def user_exists(userid: int) -> bool:
+    if userid in known_users:
+        return True
+
+    # index is not loaded yet or user was registered by another instance of bot
+    if exists := await get_user_profile(userid) is not None:
+        known_users.add(userid)
+
+    return exists
+
+
+async def get_user_consent(userid: int) -> bool | None:
+    return profile.consent if (profile := await get_user_profile(userid)) is not None else False
+
+
+async def get_user_geocheck(userid: int) -> bool | None:
+    return profile.geocheck if (profile := await get_user_profile(userid)) is not None else None
+
+
+async def get_user_air_quality(userid: int) -> bool | None:
+    return profile.airquality if (profile := await get_user_profile(userid)) is not None else None
+
+
+async def get_user_default_parcel_machine(userid: int) -> str | None:
+    return profile.default_parcel_machine if (profile := await get_user_profile(userid)) is not None else None
+
+
+async def get_user_location(userid: int) -> dict | None:
+    if (profile := await get_user_profile(userid)) is None:
+        return None
+
+    return {
+        'location': (profile.latitude, profile.longitude),
+        'location_time': profile.location_time
+    }
+
+
+async def get_default_phone_number(userid: int) -> PhoneNumberProfile | None:
+    if (profile := await get_user_profile(userid)) is None or profile.default_phone_number is None:
+        return None
+
+    return profile.phone_numbers.get(profile.default_phone_number)
+
+
+async def get_user_phone_numbers(userid: int) -> List[PhoneNumberProfile]:
+    return list(profile.phone_numbers.values()) if (profile := await get_user_profile(userid)) is not None else []
+
+
+async def count_user_phone_numbers(userid: int) -> int:
+    return len(profile.phone_numbers) if (profile := await get_user_profile(userid)) is not None else 0
+
+
+async def set_user_consent(event, consent: bool):
+    if result := await _set_user_consent(event=event, consent=consent):
+        profile_cache.update(event.sender.id, consent=consent)
+
+    return result
+
+
+async def update_user_location(userid: int, lat: float, long: float, loc_time: datetime):
+    await _update_user_location(userid=userid, lat=lat, long=long, loc_time=loc_time)
+    profile_cache.update(userid, latitude=lat, longitude=long, location_time=loc_time)
+
+
+async def edit_default_parcel_machine(event, default_parcel_machine: int | str):
+    await _edit_default_parcel_machine(event=event, default_parcel_machine=default_parcel_machine)
+    profile_cache.update(event.sender.id, default_parcel_machine=default_parcel_machine)
+
+
+async def edit_default_phone_number(event, default_phone_number: int | str):
+    await _edit_default_phone_number(event=event, default_phone_number=default_phone_number)
+    # database ignores phone numbers user does not own, so does the cache
+    if (profile := profile_cache.get(event.sender.id)) is not None and \
+            int(default_phone_number) in profile.phone_numbers:
+        profile_cache.update(event.sender.id, default_phone_number=int(default_phone_number))
+    else:
+        profile_cache.invalidate(event.sender.id)
+
+
+async def edit_phone_number_config(event, phone_number: int | str, userid: int | None = None, **fields):
+    await _edit_phone_number_config(event=event, phone_number=phone_number, userid=userid, **fields)
+    userid = event.sender.id if event is not None else userid
+    # only notifications flag of phone number is part of profile, tokens and sms codes are not
+    if fields.get('notifications') is not None:
+        profile_cache.invalidate(userid)
+
+
+async def add_user(event, geocheck=True, airquality=True):
+    user = await _add_user(event=event, geocheck=geocheck, airquality=airquality)
+    profile_cache.invalidate(event.sender.id)
+    known_users.add(event.sender.id)
+    return user
+
+
+async def add_phone_number_config(event, prefix: str, phone_number: str, notifications: bool = True):
+    await _add_phone_number_config(event=event, prefix=prefix, phone_number=phone_number, notifications=notifications)
+    profile_cache.invalidate(event.sender.id)
+
+
+async def delete_user(event):
+    await _delete_user(event=event)
+    profile_cache.invalidate(event.sender.id)
+    known_users.discard(event.sender.id)
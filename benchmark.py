@@ -0,0 +1,435 @@
+"""Offline end-to-end benchmark of the bot.
+
+Starts local stand-in of Inpost API, seeds SQLite database with users and feeds synthetic telegram updates into
+handlers registered by main.register_handlers, then reports throughput and latency of listing, details, QR code and
+compartment opening flows for every level of concurrency:
+
+    python benchmark.py --users 1,10,100 --requests 20 --inpost-latency 0.05
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from collections import deque
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Deque, Dict, List, Tuple
+
+import inpost.api
+import yaml
+from aiohttp import web
+from inpost.static import ParcelType
+
+from callbacks import ParcelAction, encode_parcel_callback
+
+INPOST_API = 'https://api-inmobile-pl.easypack24.net'
+FLOWS = ('listing', 'details', 'qr', 'open_compartment')
+BASE_USERID = 100000
+BASE_PHONE_NUMBER = 600000000
+
+
+def fake_point() -> dict:
+    return {'name': 'KRA01M', 'location': {'latitude': 50.06, 'longitude': 19.94}, 'locationDescription': 'Benchmark',
+            'openingHours': '24/7', 'addressDetails': {'postCode': '30-001', 'city': 'Krakow',
+                                                       'province': 'malopolskie', 'street': 'Main',
+                                                       'buildingNumber': '1'},
+            'virtual': 0, 'pointType': 'PL', 'type': ['PARCEL_LOCKER'], 'location247': True, 'doubled': False,
+            'imageUrl': '', 'easyAccessZone': False, 'airSensor': False}
+
+
+def fake_parcel(shipment_number: str, phone_number: int, status: str, multi: dict | None = None) -> dict:
+    parcel = {'shipmentNumber': shipment_number, 'shipmentType': 'parcel', 'openCode': '123456',
+              'qrCode': f'P|{phone_number}|{shipment_number[-6:]}', 'storedDate': '2023-05-01T10:00:00.000Z',
+              'expiryDate': '2023-05-03T10:00:00.000Z', 'parcelSize': 'A',
+              'receiver': {'phoneNumber': {'prefix': '+48', 'value': str(phone_number)}, 'email': 'bench@example.com',
+                           'name': 'Benchmark'},
+              'sender': {'name': 'Shop'}, 'pickUpPoint': fake_point(), 'status': status,
+              'eventLog': [{'type': 'PARCEL_STATUS', 'name': 'CONFIRMED', 'date': '2023-04-30T10:00:00.000Z'},
+                           {'type': 'PARCEL_STATUS', 'name': status, 'date': '2023-05-01T10:00:00.000Z'}],
+              'operations': {'manualArchive': True, 'canShareParcel': True, 'collect': True},
+              'ownershipStatus': 'OWN'}
+    if multi is not None:
+        parcel['multiCompartment'] = multi
+
+    return parcel
+
+
+def fake_parcels(phone_number: int, count: int) -> List[dict]:
+    """Parcels of single account, every tenth pair shares multicompartment, others cycle through a few statuses"""
+    statuses = ['READY_TO_PICKUP', 'OUT_FOR_DELIVERY', 'DELIVERED']
+    parcels = []
+    for i in range(count):
+        shipment_number = f'{phone_number}{i:06d}'
+        if i % 10 == 0 and i + 1 < count:
+            uuid = f'multi-{phone_number}-{i}'
+            parcels.append(fake_parcel(shipment_number, phone_number, 'READY_TO_PICKUP',
+                                       multi={'uuid': uuid, 'presentation': True, 'collected': False,
+                                              'shipmentNumbers': [f'{phone_number}{i + 1:06d}']}))
+        elif i % 10 == 1:
+            parcels.append(fake_parcel(shipment_number, phone_number, 'READY_TO_PICKUP',
+                                       multi={'uuid': f'multi-{phone_number}-{i - 1}', 'presentation': False,
+                                              'collected': False}))
+        else:
+            parcels.append(fake_parcel(shipment_number, phone_number, statuses[i % len(statuses)]))
+
+    return parcels
+
+
+class FakeInpostApi:
+    """Local aiohttp stand-in for endpoints of Inpost API used by the bot, answering after configured latency"""
+
+    def __init__(self, parcel_count: int = 20, latency: float = 0.05):
+        self.parcel_count = parcel_count
+        self.latency = latency
+        self.requests = 0
+        self._parcels: Dict[int, List[dict]] = {}
+        self._runner: web.AppRunner | None = None
+
+    def parcels(self, phone_number: int) -> List[dict]:
+        if phone_number not in self._parcels:
+            self._parcels[phone_number] = fake_parcels(phone_number, self.parcel_count)
+
+        return self._parcels[phone_number]
+
+    def ready_shipment_numbers(self, phone_number: int) -> List[str]:
+        return [parcel['shipmentNumber'] for parcel in self.parcels(phone_number)
+                if parcel['status'] == 'READY_TO_PICKUP']
+
+    async def _account(self, request: web.Request) -> List[dict]:
+        # every seeded account gets `Bearer benchmark-<phone number>` token
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        return self.parcels(int(request.headers['Authorization'].rsplit('-', 1)[1]))
+
+    async def tracked(self, request: web.Request) -> web.Response:
+        return web.json_response({'parcels': await self._account(request)})
+
+    async def parcel(self, request: web.Request) -> web.Response:
+        shipment_number = request.match_info['shipment_number']
+        for parcel in await self._account(request):
+            if parcel['shipmentNumber'] == shipment_number:
+                return web.json_response(parcel)
+
+        return web.json_response({}, status=404)
+
+    async def multi(self, request: web.Request) -> web.Response:
+        uuid = request.match_info['uuid']
+        return web.json_response({'parcels': [parcel for parcel in await self._account(request)
+                                              if parcel.get('multiCompartment', {}).get('uuid') == uuid]})
+
+    async def friends(self, request: web.Request) -> web.Response:
+        await self._account(request)
+        return web.json_response({'sharedWith': [], 'friends': []})
+
+    async def collect(self, request: web.Request) -> web.Response:
+        await self._account(request)
+        return web.json_response({'sessionUuid': 'benchmark', 'sessionExpirationTime': 60000})
+
+    async def open(self, request: web.Request) -> web.Response:
+        await self._account(request)
+        return web.json_response({'compartment': {'name': '1R1', 'location': {'side': 'L', 'column': '1', 'row': '1'}},
+                                  'openCompartmentWaitingTime': 30, 'actionTime': 20, 'confirmActionTime': 20})
+
+    async def status(self, request: web.Request) -> web.Response:
+        await self._account(request)
+        return web.json_response({'status': 'OPENED'})
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_get('/v4/parcels/tracked', self.tracked)
+        app.router.add_get('/v4/parcels/tracked/{shipment_number}', self.parcel)
+        app.router.add_get('/v4/parcels/multi/{uuid}', self.multi)
+        app.router.add_get('/v1/friends/{shipment_number}', self.friends)
+        app.router.add_post('/v2/collect/validate', self.collect)
+        app.router.add_post('/v1/collect/compartment/open', self.open)
+        app.router.add_post('/v1/collect/compartment/status', self.status)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host='127.0.0.1', port=0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return f'http://{host}:{port}'
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def point_inpost_at(base_url: str):
+    """Redirects inpost library to local API, its endpoints are module level constants"""
+    for name, value in list(vars(inpost.api).items()):
+        if name.endswith('_url') and isinstance(value, str) and value.startswith(INPOST_API):
+            setattr(inpost.api, name, base_url + value[len(INPOST_API):])
+
+
+class FakeMessage:
+    def __init__(self, text: str = '', photo=None, geo=None):
+        self.text = self.raw_text = text
+        self.photo = photo
+        self.geo = geo
+        self.contact = None
+
+
+class FakeTelegram:
+    """Stands in for TelegramClient: collects handlers registered by main and answers every request after latency"""
+
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+        self.sent = 0
+        self.handlers = {}
+        # kept per task, so concurrent updates of single user do not take each other's answers
+        self._script: ContextVar[Tuple[int, Deque, Deque] | None] = ContextVar('script', default=None)
+        self._photo_ids = iter(range(1, 2 ** 62))
+
+    def on(self, event_builder):
+        def decorator(func):
+            self.handlers[func.__name__] = func
+            return func
+
+        return decorator
+
+    async def respond(self, message: str = '', *args, file=None, **kwargs) -> FakeMessage:
+        self.sent += 1
+        await asyncio.sleep(self.latency)
+        photo = SimpleNamespace(id=next(self._photo_ids), access_hash=1, file_reference=b'benchmark') \
+            if file is not None else None
+        return FakeMessage(text=message, photo=photo)
+
+    def script(self, chat_id: int, responses: List = (), events: List = ()):
+        """Sets what user answers in next conversation of current task, messages for get_response and events for
+        wait_event"""
+        self._script.set((chat_id, deque(responses), deque(events)))
+
+    def conversation(self, chat_id: int) -> 'FakeConversation':
+        if (script := self._script.get()) is not None and script[0] == chat_id:
+            self._script.set(None)
+            return FakeConversation(self, chat_id, *script[1:])
+
+        return FakeConversation(self, chat_id, deque(), deque())
+
+
+class FakeEvent:
+    def __init__(self, telegram: FakeTelegram, userid: int, data: bytes | None = None, text: str = ''):
+        self._telegram = telegram
+        self.sender = SimpleNamespace(id=userid)
+        self.sender_id = self.chat_id = userid
+        self.data = data
+        self.text = self.raw_text = text
+        self.message = FakeMessage(text=text)
+
+    async def reply(self, *args, **kwargs) -> FakeMessage:
+        return await self._telegram.respond(*args, **kwargs)
+
+    async def edit(self, *args, **kwargs) -> FakeMessage:
+        return await self._telegram.respond(*args, **kwargs)
+
+    async def answer(self, *args, **kwargs) -> FakeMessage:
+        return await self._telegram.respond(*args, **kwargs)
+
+
+class FakeConversation:
+    def __init__(self, telegram: FakeTelegram, chat_id: int, responses: Deque, events: Deque):
+        self._telegram = telegram
+        self.chat_id = chat_id
+        self._responses = responses
+        self._events = events
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def send_message(self, *args, **kwargs) -> FakeMessage:
+        return await self._telegram.respond(*args, **kwargs)
+
+    async def get_response(self, timeout: float | None = None):
+        if not self._responses:  # user did not answer
+            raise asyncio.TimeoutError
+
+        return self._responses.popleft()
+
+    async def wait_event(self, event=None, timeout: float | None = None):
+        if not self._events:
+            raise asyncio.TimeoutError
+
+        return self._events.popleft()
+
+    def cancel(self):
+        pass
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.errors = 0
+
+    def emit(self, record: logging.LogRecord):
+        self.errors += 1
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[round(q * (len(ordered) - 1))] if ordered else 0.0
+
+
+def benchmark_config(workdir: str, args: argparse.Namespace) -> dict:
+    config = {
+        'bot_token': 'benchmark',
+        'log_level': 'WARNING',
+        'database_settings': {'provider': 'sqlite', 'filename': os.path.join(workdir, 'benchmark.sqlite'),
+                              'create_db': True},
+        'telethon_settings': {},
+        'parcel_list_page_size': 5,
+        'multicompartment_concurrency': 5,
+        'tracing': {'slow_update_threshold': args.slow_update_threshold},
+    }
+    if not args.telegram_rate_limits:  # measure the bot, not telegram limits outbox obeys
+        config['outbox'] = {'global_rate': 1e6, 'global_burst': 1000000, 'chat_rate': 1e6, 'chat_burst': 1000000}
+
+    return config
+
+
+async def seed_users(telegram: FakeTelegram, users: List[Tuple[int, int]]):
+    """Creates initialized users with single phone number each, default parcel machine skips location check"""
+    import async_database
+
+    for userid, phone_number in users:
+        event = FakeEvent(telegram, userid)
+        await async_database.add_user(event=event, geocheck=False, airquality=False)
+        await async_database.add_phone_number_config(event=event, prefix='+48', phone_number=str(phone_number))
+        await async_database.edit_default_phone_number(event=event, default_phone_number=phone_number)
+        await async_database.edit_default_parcel_machine(event=event, default_parcel_machine=fake_point()['name'])
+        await async_database.edit_phone_number_config(event=event, phone_number=phone_number,
+                                                      auth_token=f'Bearer benchmark-{phone_number}',
+                                                      refr_token='benchmark')
+
+
+def synthetic_users(count: int) -> List[Tuple[int, int]]:
+    return [(BASE_USERID + i, BASE_PHONE_NUMBER + i) for i in range(count)]
+
+
+def parcel_event(telegram: FakeTelegram, api: FakeInpostApi, action: ParcelAction, userid: int, phone_number: int,
+                 request: int, parcel_type: ParcelType = ParcelType.TRACKED) -> FakeEvent:
+    """Button press of user's parcel, consecutive requests rotate through parcels ready to pick up"""
+    shipment_numbers = api.ready_shipment_numbers(phone_number)
+    if action == ParcelAction.OPEN_COMPARTMENT:
+        telegram.script(userid, events=[FakeEvent(telegram, userid, data=b'Yes!')])
+
+    return FakeEvent(telegram, userid, data=encode_parcel_callback(action, parcel_type, phone_number,
+                                                                   shipment_numbers[request % len(shipment_numbers)]))
+
+
+async def run(args: argparse.Namespace):
+    # these modules read config.yml of current directory when imported, so they are imported once it is in place
+    import async_database
+    from cache import parcel_cache, profile_cache, qr_code_cache
+    from clients import InpostRegistry
+    from main import register_handlers
+    from outbox import outbox
+
+    api = FakeInpostApi(parcel_count=args.parcels, latency=args.inpost_latency)
+    point_inpost_at(await api.start())
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    registry = InpostRegistry()
+    register_handlers(client=telegram, inpost_registry=registry, config=benchmark_config(os.getcwd(), args))
+
+    users = synthetic_users(max(args.users))
+    await seed_users(telegram, users)
+
+    def update(flow: str, userid: int, phone_number: int, request: int) -> Tuple[str, FakeEvent]:
+        match flow:
+            case 'listing':
+                return 'get_packages', FakeEvent(telegram, userid, data=b'Pending')
+            case 'details':
+                return 'handle_parcel', parcel_event(telegram, api, ParcelAction.DETAILS, userid, phone_number,
+                                                     request)
+            case 'qr':
+                return 'handle_parcel', parcel_event(telegram, api, ParcelAction.QR_CODE, userid, phone_number,
+                                                     request)
+            case 'open_compartment':
+                return 'handle_parcel', parcel_event(telegram, api, ParcelAction.OPEN_COMPARTMENT, userid,
+                                                     phone_number, request)
+
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+
+    async def user_session(flow: str, userid: int, phone_number: int, latencies: List[float]):
+        for request in range(args.requests):
+            handler, event = update(flow, userid, phone_number, request)
+            started = time.perf_counter()
+            await telegram.handlers[handler](event)
+            latencies.append(time.perf_counter() - started)
+
+    print(f'{"flow":<18}{"users":>6}{"updates":>9}{"updates/s":>11}{"p50 ms":>9}{"p99 ms":>9}'
+          f'{"api calls":>11}{"sent":>7}{"errors":>8}')
+    try:
+        for flow in args.flows:
+            for concurrency in args.users:
+                parcel_cache.clear()  # every scenario starts cold, so they do not depend on order
+                qr_code_cache.clear()
+                profile_cache.clear()
+                latencies: List[float] = []
+                api_requests, sent, failed = api.requests, telegram.sent, errors.errors
+                started = time.perf_counter()
+                await asyncio.gather(*(user_session(flow, userid, phone_number, latencies)
+                                       for userid, phone_number in users[:concurrency]))
+                elapsed = time.perf_counter() - started
+
+                print(f'{flow:<18}{concurrency:>6}{len(latencies):>9}{len(latencies) / elapsed:>11.1f}'
+                      f'{percentile(latencies, 0.5) * 1000:>9.1f}{percentile(latencies, 0.99) * 1000:>9.1f}'
+                      f'{api.requests - api_requests:>11}{telegram.sent - sent:>7}{errors.errors - failed:>8}')
+    finally:
+        await outbox.close()
+        await registry.close()
+        await api.close()
+        async_database.executor.shutdown()
+
+
+def add_environment_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--parcels', type=int, default=20, help='parcels of every account')
+    parser.add_argument('--inpost-latency', type=float, default=0.05, help='seconds fake Inpost API waits per request')
+    parser.add_argument('--telegram-latency', type=float, default=0.01, help='seconds every telegram request takes')
+    parser.add_argument('--telegram-rate-limits', action='store_true',
+                        help='keep default outbox rate limits instead of lifting them')
+    parser.add_argument('--slow-update-threshold', type=float, default=float('inf'),
+                        help='log timelines of updates slower than that many seconds')
+    parser.add_argument('--workdir', help='directory for config.yml and SQLite database, temporary one by default')
+
+
+def run_in_workdir(args: argparse.Namespace, run: Callable[[argparse.Namespace], Awaitable]):
+    """Writes bot config with SQLite database into work directory and runs the coroutine from there"""
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = os.path.abspath(args.workdir or tmp)
+        os.makedirs(workdir, exist_ok=True)
+        with open(os.path.join(workdir, 'config.yml'), 'w') as f:
+            yaml.safe_dump(benchmark_config(workdir, args), f)
+
+        os.chdir(workdir)
+        # inpost library sets DEBUG level on its loggers, so records are filtered by handler instead
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.WARNING)
+        logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.WARNING,
+                            handlers=[handler])
+        asyncio.run(run(args))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of the bot')
+    parser.add_argument('--users', default='1,10,100', help='comma separated levels of concurrent users')
+    parser.add_argument('--requests', type=int, default=20, help='updates sent by every user in each scenario')
+    parser.add_argument('--flows', default=','.join(FLOWS), help=f'comma separated subset of {", ".join(FLOWS)}')
+    add_environment_arguments(parser)
+    args = parser.parse_args()
+    args.users = [int(users) for users in args.users.split(',')]
+    args.flows = [flow for flow in args.flows.split(',') if flow]
+    if unknown := set(args.flows) - set(FLOWS):
+        parser.error(f'unknown flows: {", ".join(sorted(unknown))}')
+
+    run_in_workdir(args, run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+import hashlib
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from inpost.static import Parcel, ParcelStatus, ParcelType
+
+from database import config
+
+# delivered (and otherwise final) parcels do not change anymore, parcels waiting in parcel machine change with every
+# pickup, so they are kept only for a moment, everything in between is kept for a few minutes
+default_status_ttls = {
+    ParcelStatus.DELIVERED.name: 86400,
+    ParcelStatus.RETURNED_TO_SENDER.name: 86400,
+    ParcelStatus.CANCELED.name: 86400,
+    ParcelStatus.READY_TO_PICKUP.name: 30,
+    ParcelStatus.READY_TO_PICKUP_FROM_POK.name: 30,
+    ParcelStatus.READY_TO_PICKUP_FROM_BRANCH.name: 30,
+    ParcelStatus.STACK_IN_BOX_MACHINE.name: 30,
+    ParcelStatus.STACK_IN_CUSTOMER_SERVICE_POINT.name: 30,
+}
+
+
+class ParcelCache:
+    """Bounded, LRU evicted cache of raw parcels and multicompartment groups with time to live depending on parcel
+    status"""
+
+    def __init__(self, max_size: int = 10000, default_ttl: int = 300, status_ttls: Dict[str, int] | None = None):
+        self.max_size = max_size
+        self.default_ttl = default_ttl
+        self.status_ttls = {**default_status_ttls, **(status_ttls or {})}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.group_hits = 0
+        self.group_misses = 0
+        self._parcels: OrderedDict[Tuple[int, str, str], Tuple[dict, float]] = OrderedDict()
+        self._groups: OrderedDict[Tuple[int, str], Tuple[List[dict], float]] = OrderedDict()
+        self._group_members: Dict[Tuple[int, str], str] = {}  # (phone number, shipment number) -> multi uuid
+
+    @staticmethod
+    def _key(phone_number: int | str, shipment_number: int | str, parcel_type: ParcelType) -> Tuple[int, str, str]:
+        # inpost enums are not hashable, so their names are used in keys and ttl mapping
+        return int(phone_number), str(shipment_number), parcel_type.name
+
+    def get(self, phone_number: int | str, shipment_number: int | str, parcel_type: ParcelType) -> dict | None:
+        key = self._key(phone_number, shipment_number, parcel_type)
+        entry = self._parcels.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._parcels[key]
+
+            self.misses += 1
+            return None
+
+        self._parcels.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def ttl(self, status: ParcelStatus) -> int:
+        return self.status_ttls.get(status.name, self.default_ttl)
+
+    def put(self, phone_number: int | str, shipment_number: int | str, parcel_type: ParcelType,
+            status: ParcelStatus, raw: dict):
+        key = self._key(phone_number, shipment_number, parcel_type)
+        self._parcels[key] = (raw, time.monotonic() + self.ttl(status))
+        self._parcels.move_to_end(key)
+
+        # parcel seen in listing moved on, so group holding its older state is outdated
+        if (multi_uuid := self._group_members.get(key[:2])) is not None and \
+                any(member.get('shipmentNumber') == key[1] and member.get('status') != raw.get('status')
+                    for member in self._groups[(key[0], multi_uuid)][0]):
+            self._drop_group((key[0], multi_uuid))
+
+        while len(self._parcels) > self.max_size:
+            self._parcels.popitem(last=False)
+            self.evictions += 1
+
+    def get_group(self, phone_number: int | str, multi_uuid: str) -> List[dict] | None:
+        key = (int(phone_number), multi_uuid)
+        entry = self._groups.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                self._drop_group(key)
+
+            self.group_misses += 1
+            return None
+
+        self._groups.move_to_end(key)
+        self.group_hits += 1
+        return entry[0]
+
+    def put_group(self, phone_number: int | str, multi_uuid: str, parcels: List[Tuple[Parcel, dict]]):
+        # group lives as long as its most volatile parcel
+        key = (int(phone_number), multi_uuid)
+        ttl = min((self.ttl(parcel.status) for parcel, _ in parcels), default=self.default_ttl)
+        self._groups[key] = ([raw for _, raw in parcels], time.monotonic() + ttl)
+        self._groups.move_to_end(key)
+        for parcel, _ in parcels:
+            self._group_members[(key[0], str(parcel.shipment_number))] = multi_uuid
+
+        while len(self._groups) > self.max_size:
+            self._drop_group(next(iter(self._groups)))
+            self.evictions += 1
+
+    def _drop_group(self, key: Tuple[int, str]):
+        if (entry := self._groups.pop(key, None)) is None:
+            return
+
+        for raw in entry[0]:
+            self._group_members.pop((key[0], str(raw.get('shipmentNumber'))), None)
+
+    def invalidate(self, phone_number: int | str, shipment_number: int | str):
+        """Drops parcel and multicompartment group it belongs to, e.g. after it was collected"""
+        for parcel_type in ParcelType:
+            self._parcels.pop(self._key(phone_number, shipment_number, parcel_type), None)
+
+        if (multi_uuid := self._group_members.get((int(phone_number), str(shipment_number)))) is not None:
+            self._drop_group((int(phone_number), multi_uuid))
+
+    def clear(self):
+        self._parcels.clear()
+        self._groups.clear()
+        self._group_members.clear()
+
+    def stats(self) -> Dict[str, int | float]:
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._parcels),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'groups': len(self._groups),
+            'group_hits': self.group_hits,
+            'group_misses': self.group_misses,
+        }
+
+
+def qr_code_hash(qr_code: str) -> str:
+    return hashlib.sha256(qr_code.encode()).hexdigest()
+
+
+class QRCodeCache:
+    """Bounded, LRU evicted cache of rendered QR images, keyed by hash of QR code value"""
+
+    def __init__(self, max_size: int = 1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._images: OrderedDict[str, bytes] = OrderedDict()
+
+    def get(self, qr_hash: str) -> bytes | None:
+        if (image := self._images.get(qr_hash)) is None:
+            self.misses += 1
+            return None
+
+        self._images.move_to_end(qr_hash)
+        self.hits += 1
+        return image
+
+    def put(self, qr_hash: str, image: bytes):
+        self._images[qr_hash] = image
+        self._images.move_to_end(qr_hash)
+
+        while len(self._images) > self.max_size:
+            self._images.popitem(last=False)
+
+    def clear(self):
+        self._images.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._images),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class PhoneNumberProfile:
+    def __init__(self, phone_number: int, prefix: str, notifications: bool):
+        self.phone_number = phone_number
+        self.prefix = prefix
+        self.notifications = notifications
+
+
+class UserProfile:
+    """Settings of user and phone numbers they own, read from database at once"""
+
+    def __init__(self, userid: int, consent: bool | None, default_phone_number: int | None,
+                 default_parcel_machine: str | None, geocheck: bool, airquality: bool, latitude: float | None,
+                 longitude: float | None, location_time: datetime | None, phone_numbers: List[dict]):
+        self.userid = userid
+        self.consent = consent
+        self.default_phone_number = default_phone_number
+        self.default_parcel_machine = default_parcel_machine
+        self.geocheck = geocheck
+        self.airquality = airquality
+        self.latitude = latitude
+        self.longitude = longitude
+        self.location_time = location_time
+        self.phone_numbers = {pn['phone_number']: PhoneNumberProfile(**pn) for pn in phone_numbers}
+
+
+class ProfileCache:
+    """Bounded, LRU evicted cache of user profiles, kept up to date by writes going through async_database"""
+
+    def __init__(self, max_size: int = 10000, ttl: int = 600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0  # sequence number of last write, taken before profile is read
+        # sequence number of last write of every recently changed user, oldest ones are forgotten
+        self._written: OrderedDict[int, int] = OrderedDict()
+        self._forgotten = 0
+        self._profiles: OrderedDict[int, Tuple[UserProfile, float]] = OrderedDict()
+
+    def get(self, userid: int) -> UserProfile | None:
+        entry = self._profiles.get(userid)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._profiles[userid]
+
+            self.misses += 1
+            return None
+
+        self._profiles.move_to_end(userid)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, profile: UserProfile, writes: int):
+        # profile was read while it was being changed, users whose writes were forgotten are assumed changed
+        if max(self._written.get(profile.userid, 0), self._forgotten) > writes:
+            return
+
+        self._profiles[profile.userid] = (profile, time.monotonic() + self.ttl)
+        self._profiles.move_to_end(profile.userid)
+
+        while len(self._profiles) > self.max_size:
+            self._profiles.popitem(last=False)
+
+    def _write(self, userid: int):
+        self.writes += 1
+        self._written[userid] = self.writes
+        self._written.move_to_end(userid)
+        while len(self._written) > self.max_size:
+            _, self._forgotten = self._written.popitem(last=False)
+
+    def update(self, userid: int, **fields):
+        self._write(userid)
+        if (entry := self._profiles.get(userid)) is not None:
+            for name, value in fields.items():
+                setattr(entry[0], name, value)
+
+    def invalidate(self, userid: int):
+        self._write(userid)
+        self._profiles.pop(userid, None)
+
+    def clear(self):
+        self._profiles.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._profiles),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class UserIndex:
+    """Ids of registered users kept as sorted array of 64 bit integers, 8 bytes per user.
+
+    Until it is loaded it knows nobody, changes made in the meantime are applied on top of loaded ids."""
+
+    def __init__(self, max_pending: int = 10000):
+        self.loaded = False
+        self.max_pending = max_pending
+        self._ids = array('q')
+        self._pending: List[Tuple[bool, int]] = []  # (added, userid) made while loading
+
+    def __contains__(self, userid: int) -> bool:
+        i = bisect_left(self._ids, userid)
+        return i < len(self._ids) and self._ids[i] == userid
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def load(self, userids: Iterable[int]):
+        """Replaces known ids with given ones, they have to be in ascending order"""
+        self._ids = array('q', userids)
+        self.loaded = True
+        for added, userid in self._pending:
+            if added:
+                self.add(userid)
+            else:
+                self.discard(userid)
+
+        self._pending.clear()
+
+    def add(self, userid: int):
+        if not self.loaded:
+            # registered users are loaded anyway, skipped ones are only found in database once more
+            if len(self._pending) < self.max_pending:
+                self._pending.append((True, userid))
+        elif (i := bisect_left(self._ids, userid)) == len(self._ids) or self._ids[i] != userid:
+            self._ids.insert(i, userid)
+
+    def discard(self, userid: int):
+        if not self.loaded:
+            self._pending.append((False, userid))
+        elif (i := bisect_left(self._ids, userid)) < len(self._ids) and self._ids[i] == userid:
+            del self._ids[i]
+
+
+parcel_cache = ParcelCache(**config.get('parcel_cache', {}))
+qr_code_cache = QRCodeCache(**config.get('qr_code_cache', {}))
+profile_cache = ProfileCache(**config.get('profile_cache', {}))
+known_users = UserIndex()
@@ -0,0 +1,48 @@
+import struct
+from enum import IntEnum
+from typing import Tuple
+
+from inpost.static import ParcelType
+
+# first byte of compact parcel button data, it is not printable, so it never clashes with text buttons
+PARCEL_CALLBACK_MAGIC = b'\xb1'
+
+# magic, action, parcel type, phone number, followed by shipment number in ascii
+_header = struct.Struct('>cBBI')
+_parcel_types = [parcel_type.name for parcel_type in ParcelType]  # inpost enums are not hashable
+
+
+class ParcelAction(IntEnum):
+    SHOW = 1
+    OPEN_CODE = 2
+    QR_CODE = 3
+    DETAILS = 4
+    SHARE = 5
+    OPEN_COMPARTMENT = 6
+
+
+# text data of parcel buttons sent before callback data became compact, they may still live in chats
+legacy_parcel_actions = {
+    b'Open Code': ParcelAction.OPEN_CODE,
+    b'QR Code': ParcelAction.QR_CODE,
+    b'Details': ParcelAction.DETAILS,
+    b'Share': ParcelAction.SHARE,
+    b'Open Compartment': ParcelAction.OPEN_COMPARTMENT,
+}
+
+
+def encode_parcel_callback(action: ParcelAction, parcel_type: ParcelType, phone_number: int | str,
+                           shipment_number: str) -> bytes:
+    data = _header.pack(PARCEL_CALLBACK_MAGIC, action, _parcel_types.index(parcel_type.name), int(phone_number)) + \
+           str(shipment_number).encode('ascii')
+
+    if len(data) > 64:  # telegram limit for callback data
+        raise ValueError(f'Callback data for {shipment_number} is {len(data)} bytes long, 64 is allowed')
+
+    return data
+
+
+def decode_parcel_callback(data: bytes) -> Tuple[ParcelAction, ParcelType, int, str]:
+    _, action, parcel_type, phone_number = _header.unpack_from(data)
+    return (ParcelAction(action), ParcelType[_parcel_types[parcel_type]], phone_number,
+            data[_header.size:].decode('ascii'))
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Tuple
+
+from aiohttp import ClientSession, TCPConnector
+from inpost import Inpost
+from inpost.static import NotAuthenticatedError
+
+from async_database import get_inpost_obj
+from metrics import instrument_inpost
+from tokens import TokenManager
+from tracing import trace_inpost
+
+
+class InpostRegistry:
+    """Long-lived, LRU/TTL evicted pool of Inpost clients sharing one connection-pooled connector"""
+
+    def __init__(self, connection_limit: int = 100, connection_limit_per_host: int = 0, max_clients: int = 1000,
+                 client_ttl: int = 900, keepalive_timeout: int = 60, token_manager: TokenManager | None = None):
+        self.connection_limit = connection_limit
+        self.connection_limit_per_host = connection_limit_per_host
+        self.max_clients = max_clients
+        self.client_ttl = client_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.token_manager = token_manager
+        self._connector: TCPConnector | None = None
+        self._clients: OrderedDict[Tuple[int, int], Tuple[Inpost, float]] = OrderedDict()
+        # evicted clients may still be used by handlers waiting for user input, so they are closed after client_ttl
+        self._retired: Deque[Tuple[Inpost, float]] = deque()
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def connector(self) -> TCPConnector:
+        # connector has to be created inside running event loop, so it is done lazily
+        if self._connector is None or self._connector.closed:
+            self._connector = TCPConnector(limit=self.connection_limit,
+                                           limit_per_host=self.connection_limit_per_host,
+                                           keepalive_timeout=self.keepalive_timeout)
+
+        return self._connector
+
+    async def get(self, userid: int, phone_number: int | str) -> Inpost:
+        key = (int(userid), int(phone_number))
+        await self.evict_expired()
+
+        if key in self._clients:
+            inp, _ = self._clients.pop(key)
+            self._clients[key] = (inp, time.monotonic())
+            return await self._fresh(key, inp)
+
+        inpost_obj = await get_inpost_obj(userid=userid, phone_number=phone_number)
+        if inpost_obj is None:
+            raise NotAuthenticatedError(reason='Phone number is not initialized, use /init first!')
+
+        if key in self._clients:  # concurrent caller created it while we were waiting for database
+            return await self._fresh(key, self._clients[key][0])
+
+        inp = trace_inpost(instrument_inpost(Inpost(**inpost_obj)))
+        own_sess, inp.sess = inp.sess, ClientSession(connector=self.connector, connector_owner=False)
+        self._clients[key] = (inp, time.monotonic())
+        await own_sess.close()
+
+        while len(self._clients) > self.max_clients:
+            _, (evicted, _) = self._clients.popitem(last=False)
+            self._retired.append((evicted, time.monotonic()))
+
+        return await self._fresh(key, inp)
+
+    async def _fresh(self, key: Tuple[int, int], inp: Inpost) -> Inpost:
+        if self.token_manager is not None:
+            await self.token_manager.ensure_fresh(key, inp)
+
+        return inp
+
+    def tokens_stored(self, userid: int, phone_number: int | str, inp: Inpost):
+        """Tells token manager tokens of inp were just written to database"""
+        if self.token_manager is not None:
+            self.token_manager.stored((int(userid), int(phone_number)), inp.auth_token)
+
+    def clients(self) -> List[Tuple[Tuple[int, int], Inpost]]:
+        return [(key, inp) for key, (inp, _) in self._clients.items()]
+
+    async def evict_expired(self):
+        deadline = time.monotonic() - self.client_ttl
+        while self._clients:
+            key, (inp, last_used) = next(iter(self._clients.items()))
+            if last_used > deadline:
+                break
+
+            del self._clients[key]
+            self._retired.append((inp, time.monotonic()))
+
+        while self._retired and self._retired[0][1] <= deadline:
+            inp, _ = self._retired.popleft()
+            await inp.sess.close()
+
+    async def invalidate(self, userid: int, phone_number: int | str):
+        if (entry := self._clients.pop((int(userid), int(phone_number)), None)) is not None:
+            self._retired.append((entry[0], time.monotonic()))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'clients': len(self._clients),
+            'retired': len(self._retired),
+            'max_clients': self.max_clients,
+            'connection_limit': self.connection_limit,
+        }
+
+    async def close(self):
+        while self._clients:
+            _, (inp, _) = self._clients.popitem()
+            await inp.sess.close()
+
+        while self._retired:
+            inp, _ = self._retired.popleft()
+            await inp.sess.close()
+
+        if self._connector is not None:
+            await self._connector.close()
+
+
+class SingleFlight:
+    """Coalesces identical concurrent calls, so only first caller hits upstream and the rest await its result"""
+
+    def __init__(self):
+        self.calls = 0
+        self.saved = 0
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable]):
+        if (future := self._in_flight.get(key)) is not None:
+            self.saved += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(call())
+        self._in_flight[key] = future
+        future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        self.calls += 1
+
+        return await asyncio.shield(future)
+
+    def stats(self) -> Dict[str, int]:
+        return {'calls': self.calls, 'saved': self.saved, 'in_flight': len(self._in_flight)}
+
+
+inpost_calls = SingleFlight()
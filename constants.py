@@ -1,4 +1,8 @@
-from inpost.static import ParcelStatus, Parcel
+from typing import List
+
+from inpost.static import ParcelStatus, ParcelType, Parcel
+
+from rendering import local_datetime
 
 pending_statuses = [ParcelStatus.READY_TO_PICKUP, ParcelStatus.CONFIRMED,
                     ParcelStatus.ADOPTED_AT_SORTING_CENTER, ParcelStatus.ADOPTED_AT_SOURCE_BRANCH,
@@ -9,6 +13,20 @@ pending_statuses = [ParcelStatus.READY_TO_PICKUP, ParcelStatus.CONFIRMED,
                     ParcelStatus.STACK_IN_BOX_MACHINE, ParcelStatus.STACK_IN_CUSTOMER_SERVICE_POINT,
                     ParcelStatus.PICKUP_REMINDER_SENT, ParcelStatus.PICKUP_REMINDER_SENT_ADDRESS]
 
+fast_poll_statuses = [ParcelStatus.OUT_FOR_DELIVERY, ParcelStatus.OUT_FOR_DELIVERY_TO_ADDRESS,
+                      ParcelStatus.TAKEN_BY_COURIER, ParcelStatus.TAKEN_BY_COURIER_FROM_POK,
+                      ParcelStatus.READY_TO_PICKUP, ParcelStatus.STACK_IN_BOX_MACHINE,
+                      ParcelStatus.STACK_IN_CUSTOMER_SERVICE_POINT, ParcelStatus.PICKUP_REMINDER_SENT]
+
+# parcel list button -> (statuses, parcel type) used to query inpost
+parcel_list_filters = {
+    'Pending': (pending_statuses, ParcelType.TRACKED),
+    'Delivered': (ParcelStatus.DELIVERED, ParcelType.TRACKED),
+    'Sent': (None, ParcelType.SENT),
+    'Returns': (None, ParcelType.RETURNS),
+    'All': (None, ParcelType.TRACKED),
+}
+
 welcome_message = 'Hello!\nThis is a bot helping you to manage your InPost parcels!\n' \
                   'If you want to contribute to Inpost development you can find us there: ' \
                   '[Inpost Library](https://github.com/IFOSSA/inpost-python)\n' \
@@ -65,6 +83,34 @@ def multicompartment_message_builder(amount: int, package: Parcel, other: str) -
            f'Other parcels inside:\n{other}'
 
 
+def parcel_summary_builder(package: Parcel, group_size: int | None) -> str:
+    summary = f'📦 `{package.shipment_number}`\n' \
+              f'📤 `{package.sender.sender_name if package.sender is not None else None}`\n' \
+              f'📮 `{package.status.value}`'
+
+    if group_size is not None:
+        summary = summary + f'\n⚠️ **Multicompartment containing {group_size} parcels**'
+
+    if package.status in (ParcelStatus.STACK_IN_BOX_MACHINE, ParcelStatus.STACK_IN_CUSTOMER_SERVICE_POINT):
+        summary = summary + '\n⚠️ **Substitutionary pick up point!**'
+
+    if package.status in (ParcelStatus.READY_TO_PICKUP, ParcelStatus.STACK_IN_BOX_MACHINE,
+                          ParcelStatus.STACK_IN_CUSTOMER_SERVICE_POINT, ParcelStatus.PICKUP_REMINDER_SENT):
+        summary = summary + f'\n🫳 **Pick up until:** `{local_datetime(package.expiry_date)}`'
+
+    return summary
+
+
+def parcel_list_entry_builder(index: int, summary: str) -> str:
+    return f'**{index}.** {summary}'
+
+
+def parcel_list_message_builder(list_filter: str, entries: List[str], page: int, pages: int, amount: int) -> str:
+    return f'📋 **{list_filter} parcels: {amount}**, page {page + 1}/{pages}\n\n' + \
+           '\n\n'.join(entries) + \
+           '\n\nPress parcel number to show it with all options.'
+
+
 def compartment_message_builder(package: Parcel) -> str:
     return f'📤 **Sender:** `{package.sender.sender_name}`\n' \
            f'📦 **Shipment number:** `{package.shipment_number}`\n' \
@@ -73,9 +119,13 @@ def compartment_message_builder(package: Parcel) -> str:
            f'{package.pickup_point.street} {package.pickup_point.building_number}`'
 
 
+def events_builder(parcel: Parcel) -> str:
+    return '\n'.join(f'{local_datetime(status.date):>22}: {status.name.value}' for status in parcel.event_log)
+
+
 def details_message_builder(parcel: Parcel, events: str) -> str:
     return f'**Shipment number**: {parcel.shipment_number}\n' \
-           f'**Stored**: {parcel.stored_date.to("local").format("DD.MM.YYYY HH:mm")}\n' \
+           f'**Stored**: {local_datetime(parcel.stored_date)}\n' \
            f'**Open code**: {parcel.open_code}\n' \
            f'**Events**:\n{events}\n\n'
 
@@ -88,7 +138,7 @@ def open_comp_message_builder(parcel: Parcel) -> str:
 
 
 def ready_to_pickup_message_builder(parcel: Parcel, events: str, air_quality: str | None) -> str:
-    msg = f'**Stored**: {parcel.stored_date.to("local").format("DD.MM.YYYY HH:mm")}\n' \
+    msg = f'**Stored**: {local_datetime(parcel.stored_date)}\n' \
           f'**Open code**: {parcel.open_code}\n' \
           f'**Events**:\n{events}'
 
@@ -98,14 +148,29 @@ def ready_to_pickup_message_builder(parcel: Parcel, events: str, air_quality: st
     return msg
 
 
-def out_of_range_message_builder(parcel: Parcel) -> str:
-    return f'Your location is outside the range that is allowed to open this parcel machine. ' \
-           f'Confirm that you are standing nearby, there is description:' \
-           f'\n\n**Name: {parcel.pickup_point.name}**' \
-           f'\n**Address: {parcel.pickup_point.post_code} {parcel.pickup_point.city}, ' \
-           f'{parcel.pickup_point.street} {parcel.pickup_point.building_number}**\n' \
-           f'**Description: {parcel.pickup_point.description}**\n\n' \
-           f'Do you still want me to open it for you?'
+def out_of_range_message_builder(parcel: Parcel, distance: float | None = None, nearest: str | None = None) -> str:
+    msg = f'Your location is outside the range that is allowed to open this parcel machine. ' \
+          f'Confirm that you are standing nearby, there is description:' \
+          f'\n\n**Name: {parcel.pickup_point.name}**' \
+          f'\n**Address: {parcel.pickup_point.post_code} {parcel.pickup_point.city}, ' \
+          f'{parcel.pickup_point.street} {parcel.pickup_point.building_number}**\n' \
+          f'**Description: {parcel.pickup_point.description}**\n\n'
+
+    if distance is not None:
+        msg = msg + f'You are **{distance:.0f} m** away from it.\n\n'
+
+    if nearest is not None and nearest != parcel.pickup_point.name:
+        msg = msg + f'It looks like you are standing at **{nearest}** parcel machine.\n\n'
+
+    return msg + 'Do you still want me to open it for you?'
+
+
+def notification_message_builder(package: Parcel, previous_status: ParcelStatus | None) -> str:
+    return f'🔔 **Parcel status changed!**\n\n' \
+           f'📤 **Sender:** `{package.sender.sender_name if package.sender is not None else None}`\n' \
+           f'📦 **Shipment number:** `{package.shipment_number}`\n' \
+           f'📮 **Status:** `{previous_status.value if previous_status is not None else "NEW"}` ➡️ ' \
+           f'`{package.status.value}`\n'
 
 
 def friend_invitations_message_builder(friend) -> str:
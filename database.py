@@ -1,4 +1,7 @@
-from datetime import datetime
+import hashlib
+import json
+from datetime import datetime, timedelta
+from typing import List, Tuple, Dict
 
 import yaml
 from inpost.static import ParcelType
@@ -20,6 +23,9 @@ class ParcelData(db.Entity):
     shipment_number = Required(str)
     ptype = Required(str)
     parcel = Required(Json)
+    payload_hash = Optional(str, 64, nullable=True)
+    composite_key(phone_number, shipment_number, payload_hash)
+    composite_index(phone_number, shipment_number, timestamp)
 
     def qrcode(self) -> str | None:
         return self.parcel.get('qrCode')
@@ -32,6 +38,15 @@ class ParcelData(db.Entity):
     #     return max([p for p in ParcelData.select() if p.parcel.get('shipmentNumber') == self.parcel.get('shipmentNumber')], key=lambda p: p.timestamp)
 
 
+class QRCodeMedia(db.Entity):
+    # telegram photo already uploaded for a qr code, so it can be sent again without rendering and uploading
+    qr_hash = PrimaryKey(str, 64)
+    photo_id = Required(int, size=64)
+    access_hash = Required(int, size=64)
+    file_reference = Required(bytes)
+    timestamp = Required(datetime)
+
+
 class PhoneNumberConfig(db.Entity):
     user = Required('User')
     default_to = Optional('User')
@@ -58,15 +73,52 @@ class User(db.Entity):
     location_time = Optional(datetime)
 
 
-db.generate_mapping(create_tables=True)
+class ShardLease(db.Entity):
+    shard = PrimaryKey(int)
+    owner = Optional(str)
+    expires_at = Required(datetime)
 
 
-@db_session
-def get_user_consent(userid):
-    if not User.exists(userid=userid):
-        return False
+class Worker(db.Entity):
+    worker_id = PrimaryKey(str)
+    heartbeat = Required(datetime)
+    shards = Required(int, default=0)
+    accounts = Required(int, default=0)
+    lag = Required(float, default=0)
+
+
+def upgrade_schema():
+    """Adds columns and indexes introduced after tables of existing deployment were created, Pony only creates
+    missing tables and refuses to map tables lacking columns"""
+    if db.provider.dialect not in ('SQLite', 'PostgreSQL'):
+        return
+
+    quote = db.provider.quote_name
+    with db_session:
+        table = db.provider.normalize_name('ParcelData')
+        if not db.provider.table_exists(db.get_connection(), table):  # fresh database, tables are created below
+            return
 
-    return User[userid].data_collecting_consent
+        columns = {column[0].lower() for column in db.execute(f'SELECT * FROM {quote(table)} LIMIT 0').description}
+        if 'payload_hash' not in columns:
+            db.execute(f'ALTER TABLE {quote(table)} ADD COLUMN {quote("payload_hash")} VARCHAR(64)')
+
+        # rows without hash are NULLs, which unique index does not compare, so it can be created right away
+        index = quote('unq_parceldata__phone_number_shipment_number_payload_hash')
+        db.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS {index} '
+                   f'ON {quote(table)} ({quote("phone_number")}, {quote("shipment_number")}, {quote("payload_hash")})')
+        # latest snapshot of parcel is looked up by it, without it every lookup scans the table
+        index = quote('idx_parceldata__phone_number_shipment_number_timestamp')
+        db.execute(f'CREATE INDEX IF NOT EXISTS {index} '
+                   f'ON {quote(table)} ({quote("phone_number")}, {quote("shipment_number")}, {quote("timestamp")})')
+
+
+upgrade_schema()
+db.generate_mapping(create_tables=True)
+
+
+def parcel_hash(parcel: dict) -> str:
+    return hashlib.sha256(json.dumps(parcel, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
 
 
 @db_session
@@ -82,14 +134,36 @@ def set_user_consent(event: NewMessage, consent: bool):
 
 @db_session
 def add_parcel(event: NewMessage, phone_number: int, parcel: dict, ptype: ParcelType):
-    if not User.exists(userid=event.sender.id):
+    return add_parcels(userid=event.sender.id, phone_number=phone_number, parcels=[parcel], ptype=ptype)
+
+
+@db_session
+def add_parcels(userid: str | int, phone_number: int | str, parcels: List[dict], ptype: ParcelType):
+    if not User.exists(userid=userid):
         return
 
-    user = User.get_for_update(userid=event.sender.id)
+    if isinstance(phone_number, str):
+        phone_number = int(phone_number)
+
+    user = User[userid]
     if PhoneNumberConfig.exists(phone_number=phone_number) and PhoneNumberConfig[phone_number].user == user:
         pn = PhoneNumberConfig.get_for_update(phone_number=phone_number)
-        pn.parcels.create(timestamp=datetime.now(), parcel=parcel, ptype=ptype.name,
-                          shipment_number=parcel.get('shipmentNumber'))
+        timestamp = datetime.now()
+        hashes = {(parcel.get('shipmentNumber'), parcel_hash(parcel)): parcel for parcel in parcels}
+        shipment_numbers = {shipment_number for shipment_number, _ in hashes}
+        known = {(shipment_number, payload_hash): pk for shipment_number, payload_hash, pk in
+                 select((p.shipment_number, p.payload_hash, p.id) for p in ParcelData
+                        if p.phone_number == pn and p.shipment_number in shipment_numbers)}
+
+        # unchanged payloads only get their timestamp bumped, so they still are the latest snapshot
+        unchanged = [known[key] for key in hashes if key in known]
+        for snapshot in ParcelData.select(lambda p: p.id in unchanged):
+            snapshot.timestamp = timestamp
+
+        for (shipment_number, payload_hash), parcel in hashes.items():
+            if (shipment_number, payload_hash) not in known:
+                pn.parcels.create(timestamp=timestamp, parcel=parcel, ptype=ptype.name,
+                                  shipment_number=shipment_number, payload_hash=payload_hash)
 
         commit()
     return
@@ -106,6 +180,12 @@ def phone_number_exists(phone_number):
     return PhoneNumberConfig.exists(phone_number=phone_number)
 
 
+@db_session
+def get_phone_number_owner(phone_number: int | str):
+    pn = PhoneNumberConfig.get(phone_number=phone_number)
+    return pn.user.userid if pn is not None else None
+
+
 @db_session
 def add_phone_number_config(event: NewMessage,
                             prefix: str,
@@ -124,53 +204,85 @@ def add_phone_number_config(event: NewMessage,
 
 
 @db_session
-def get_default_phone_number(userid: str | int):
-    return User.get(userid=userid).default_phone_number
+def get_pickup_points(after: int, batch_size: int) -> Tuple[int, List[dict]]:
+    """Pickup points of parcels stored after given id, returns id of last parcel read and points without duplicates"""
+    # only pickup point is extracted from payload by database, rest of parcel is not transferred
+    rows = select((p.id, p.parcel['pickUpPoint']) for p in ParcelData if p.id > after).order_by(1)[:batch_size]
+    points = {point['name']: point for _, point in rows if point}
+    return (rows[-1][0] if rows else after), list(points.values())
 
 
 @db_session
-def get_user_default_parcel_machine(userid: str | int):
-    return User.get(userid=userid).default_parcel_machine
+def get_user_ids(after: int, batch_size: int) -> List[int]:
+    return select(u.userid for u in User if u.userid > after).order_by(1)[:batch_size]
 
 
 @db_session
-def get_user_phone_numbers(userid: str | int):
-    return select(pn for pn in PhoneNumberConfig if pn.user.userid == userid)
+def get_user_profile(userid: str | int) -> dict | None:
+    if (user := User.get(userid=userid)) is None:
+        return None
+
+    return {
+        'userid': user.userid,
+        'consent': user.data_collecting_consent,
+        'default_phone_number': user.default_phone_number.phone_number if user.default_phone_number else None,
+        'default_parcel_machine': user.default_parcel_machine,
+        'geocheck': user.geocheck,
+        'airquality': user.airquality,
+        'latitude': user.latitude,
+        'longitude': user.longitude,
+        'location_time': user.location_time,
+        'phone_numbers': [{'phone_number': pn.phone_number, 'prefix': pn.prefix, 'notifications': pn.notifications}
+                          for pn in user.phone_numbers],
+    }
 
 
 @db_session
-def count_user_phone_numbers(userid: str | int):
-    return count(pn for pn in PhoneNumberConfig if pn.user.userid == userid)
+def get_user_last_parcel_with_shipment_number(userid: str | int, shipment_number: str):
+    return ParcelData.select(lambda p: p.phone_number.user.userid == userid and
+                             p.shipment_number == shipment_number).order_by(lambda pp: desc(pp.timestamp)).first()
 
 
 @db_session
-def get_user_consent(userid: str | int):
-    return User.get(userid=userid).data_collecting_consent
+def get_latest_parcel_statuses(phone_number: int | str, shipment_numbers: List[str]) -> Dict[str, str]:
+    if isinstance(phone_number, str):
+        phone_number = int(phone_number)
+
+    return {p.shipment_number: p.parcel.get('status') for p in
+            ParcelData.select(lambda p: p.phone_number.phone_number == phone_number and
+                                        p.shipment_number in shipment_numbers).order_by(ParcelData.timestamp)}
 
 
 @db_session
-def get_user_geocheck(userid: str | int):
-    return User.get(userid=userid).geocheck
+def get_qr_code_media(qr_hash: str) -> Tuple[int, int, bytes] | None:
+    if (media := QRCodeMedia.get(qr_hash=qr_hash)) is None:
+        return None
+
+    return media.photo_id, media.access_hash, media.file_reference
 
 
 @db_session
-def get_user_location(userid: str | int):
-    user = User.get(userid=userid)
-    return {
-        'location': (user.latitude, user.longitude),
-        'location_time': user.location_time
-    }
+def set_qr_code_media(qr_hash: str, photo_id: int, access_hash: int, file_reference: bytes):
+    if (media := QRCodeMedia.get(qr_hash=qr_hash)) is None:
+        QRCodeMedia(qr_hash=qr_hash, photo_id=photo_id, access_hash=access_hash, file_reference=file_reference,
+                    timestamp=datetime.now())
+    else:
+        media.set(photo_id=photo_id, access_hash=access_hash, file_reference=file_reference,
+                  timestamp=datetime.now())
+
+    commit()
 
 
 @db_session
-def get_user_air_quality(userid: str | int):
-    return User.get(userid=userid).airquality
+def delete_qr_code_media(qr_hash: str):
+    QRCodeMedia.select(lambda media: media.qr_hash == qr_hash).delete(bulk=True)
+    commit()
 
 
 @db_session
-def get_user_last_parcel_with_shipment_number(userid: str | int, shipment_number: str):
-    return list(ParcelData.select(lambda p: p.phone_number.user.userid == userid and
-                                    p.shipment_number == shipment_number).order_by(lambda pp: desc(pp.timestamp)))[0]
+def get_notification_accounts() -> List[Tuple[int, int, bool | None]]:
+    return select((pn.user.userid, pn.phone_number, pn.user.data_collecting_consent) for pn in PhoneNumberConfig
+                  if pn.notifications and pn.auth_token != '')[:]
 
 
 @db_session
@@ -184,11 +296,6 @@ def update_user_location(userid: str | int, lat: float, long: float, loc_time: d
     return
 
 
-@db_session
-def user_exists(userid: str | int):
-    return User.exists(userid=userid)
-
-
 @db_session
 def edit_default_phone_number(event: NewMessage, default_phone_number: int | str):
     if not User.exists(userid=event.sender.id):
@@ -227,11 +334,13 @@ def user_is_phone_number_owner(event: NewMessage):
 
 
 @db_session
-def edit_phone_number_config(event: NewMessage, phone_number: int | str, sms_code: int | None = None,
+def edit_phone_number_config(event: NewMessage | None, phone_number: int | str, sms_code: int | None = None,
                              refr_token: str | None = None, auth_token: str | None = None,
                              notifications: bool | None = None, default_parcel_machine: str | None = None,
-                             geocheck: bool | None = None, airquality: bool | None = None):
-    if not User.exists(userid=event.sender.id):
+                             geocheck: bool | None = None, airquality: bool | None = None, userid: int | None = None):
+    # background jobs (e.g. token refresh) have no event, they pass userid instead
+    userid = event.sender.id if event is not None else userid
+    if not User.exists(userid=userid):
         return
 
     if isinstance(phone_number, str):
@@ -240,7 +349,7 @@ def edit_phone_number_config(event: NewMessage, phone_number: int | str, sms_cod
     if not PhoneNumberConfig[phone_number]:
         return
 
-    if PhoneNumberConfig[phone_number] not in User[event.sender.id].phone_numbers:
+    if PhoneNumberConfig[phone_number] not in User[userid].phone_numbers:
         return
 
     phone_number_config = PhoneNumberConfig.get_for_update(phone_number=phone_number)
@@ -313,3 +422,136 @@ def get_inpost_obj(userid: int, phone_number: str):
                 'sms_code': inp.sms_code,
                 'auth_token': inp.auth_token,
                 'refr_token': inp.refr_token}
+
+
+@db_session
+def deduplicate_parcel_data_batch(batch_size: int) -> Tuple[int, int, int]:
+    rows = ParcelData.select(lambda p: p.payload_hash is None).order_by(ParcelData.id)[:batch_size]
+    removed = reclaimed = 0
+    for row in rows:
+        payload_hash = parcel_hash(row.parcel)
+        twin = ParcelData.get(phone_number=row.phone_number, shipment_number=row.shipment_number,
+                              payload_hash=payload_hash)
+        if twin is None:
+            row.payload_hash = payload_hash
+            continue
+
+        twin.timestamp = max(twin.timestamp, row.timestamp)
+        reclaimed += len(json.dumps(row.parcel))
+        row.delete()
+        removed += 1
+
+    commit()
+    return len(rows), removed, reclaimed
+
+
+@db_session
+def expire_parcel_data_batch(cutoff: datetime, batch_size: int) -> Tuple[int, int]:
+    # the latest snapshot of every parcel is kept, so buttons under old messages still resolve
+    rows = select(p for p in ParcelData if p.timestamp < cutoff and
+                  exists(q for q in ParcelData if q.phone_number == p.phone_number and
+                         q.shipment_number == p.shipment_number and q.timestamp > p.timestamp))[:batch_size]
+    reclaimed = 0
+    for row in rows:
+        reclaimed += len(json.dumps(row.parcel))
+        row.delete()
+
+    commit()
+    return len(rows), reclaimed
+
+
+def compact_parcel_data(retention_days: int | None = None, batch_size: int = 500) -> dict:
+    # bytes are measured as serialized JSON payload size, real on-disk savings depend on database engine
+    report = {'deduplicated_rows': 0, 'expired_rows': 0, 'reclaimed_bytes': 0}
+
+    while True:
+        processed, removed, reclaimed = deduplicate_parcel_data_batch(batch_size=batch_size)
+        report['deduplicated_rows'] += removed
+        report['reclaimed_bytes'] += reclaimed
+        if processed < batch_size:
+            break
+
+    if retention_days is not None:
+        cutoff = datetime.now() - timedelta(days=retention_days)
+        while True:
+            removed, reclaimed = expire_parcel_data_batch(cutoff=cutoff, batch_size=batch_size)
+            report['expired_rows'] += removed
+            report['reclaimed_bytes'] += reclaimed
+            if removed < batch_size:
+                break
+
+    return report
+
+
+@db_session
+def heartbeat_worker(worker_id: str, accounts: int, lag: float, lease_ttl: int):
+    now = datetime.now()
+    if (worker := Worker.get_for_update(worker_id=worker_id)) is None:
+        worker = Worker(worker_id=worker_id, heartbeat=now)
+
+    worker.heartbeat = now
+    worker.accounts = accounts
+    worker.lag = lag
+    worker.shards = count(lease for lease in ShardLease if lease.owner == worker_id and lease.expires_at > now)
+
+    select(w for w in Worker if w.heartbeat < now - timedelta(seconds=lease_ttl * 10)).delete(bulk=True)
+    commit()
+
+
+@db_session(retry=3)  # workers starting together race for creating missing shard rows
+def rebalance_shard_leases(worker_id: str, shard_count: int, lease_ttl: int) -> List[int]:
+    now = datetime.now()
+    expires_at = now + timedelta(seconds=lease_ttl)
+
+    for shard in set(range(shard_count)) - set(select(lease.shard for lease in ShardLease)):
+        ShardLease(shard=shard, owner='', expires_at=now)
+
+    live_workers = count(w for w in Worker if w.heartbeat > now - timedelta(seconds=lease_ttl) and
+                         w.worker_id != worker_id) + 1
+    fair_share = -(-shard_count // live_workers)
+
+    owned = ShardLease.select(lambda lease: lease.owner == worker_id and lease.expires_at > now and
+                                            lease.shard < shard_count).order_by(ShardLease.shard).for_update()[:]
+
+    # hand over surplus shards when other workers joined, they will pick them up on their next heartbeat
+    for lease in owned[fair_share:]:
+        lease.owner = ''
+        lease.expires_at = now
+
+    owned = owned[:fair_share]
+    for lease in owned:
+        lease.expires_at = expires_at
+
+    if len(owned) < fair_share:
+        free = ShardLease.select(lambda lease: (lease.owner == '' or lease.expires_at <= now) and
+                                               lease.shard < shard_count).order_by(ShardLease.shard).for_update()
+        for lease in free[:fair_share - len(owned)]:
+            lease.owner = worker_id
+            lease.expires_at = expires_at
+            owned.append(lease)
+
+    commit()
+    return sorted(lease.shard for lease in owned)
+
+
+@db_session
+def release_shard_leases(worker_id: str):
+    for lease in ShardLease.select(lambda lease: lease.owner == worker_id).for_update():
+        lease.owner = ''
+        lease.expires_at = datetime.now()
+
+    if Worker.exists(worker_id=worker_id):
+        Worker[worker_id].delete()
+
+    commit()
+
+
+@db_session
+def get_shard_report(lease_ttl: int) -> List[dict]:
+    now = datetime.now()
+    return [{'worker_id': w.worker_id,
+             'alive': w.heartbeat > now - timedelta(seconds=lease_ttl),
+             'heartbeat': w.heartbeat,
+             'shards': w.shards,
+             'accounts': w.accounts,
+             'lag': w.lag} for w in Worker.select().order_by(Worker.worker_id)]
@@ -2,41 +2,45 @@ import asyncio
 import logging
 
 import yaml
-from inpost import Inpost
-from inpost.static import ParcelStatus, ParcelType, PhoneNumberError, UnauthorizedError, UnidentifiedAPIError, \
+from inpost.static import ParcelType, PhoneNumberError, UnauthorizedError, UnidentifiedAPIError, \
     NotAuthenticatedError, NotFoundError, ParcelTypeError, Parcel
-from pony.orm import count
 from telethon import TelegramClient, Button
 from telethon.events import NewMessage, CallbackQuery
 
-from constants import pending_statuses, welcome_message
-from database import PhoneNumberConfig, add_user, add_phone_number_config, \
-    edit_default_phone_number, get_inpost_obj, edit_phone_number_config, get_default_phone_number, \
-    count_user_phone_numbers, get_user_phone_numbers, db_session, user_exists, get_user_last_parcel_with_shipment_number
+from async_database import executor, load_known_users, load_pickup_points, add_user, add_phone_number_config, \
+    get_phone_number_owner, edit_default_phone_number, edit_phone_number_config, get_default_phone_number, \
+    count_user_phone_numbers, get_user_phone_numbers, user_exists, get_user_last_parcel_with_shipment_number
+from cache import known_users
+from callbacks import PARCEL_CALLBACK_MAGIC, ParcelAction, decode_parcel_callback, legacy_parcel_actions
+from clients import InpostRegistry
+from constants import parcel_list_filters, welcome_message
+from maintenance import run_parcel_data_compaction
+from metrics import ErrorCounter, MetricsServer, metrics
+from notifications import ParcelNotifier
+from outbox import outbox
+from points import pickup_points
+from recorder import recorder
+from sharding import LeaseManager
+from tokens import TokenManager
+from tracing import tracer
 from utils import send_pcgs, send_qrc, show_oc, send_details, send_pcg, init_phone_number, share_parcel, \
     open_compartment, \
-    get_shipment_number_from_button
+    get_shipment_number_from_button, get_known_parcel
 
 
-async def main(config):
-    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=config['log_level'])
+def register_handlers(client: TelegramClient, inpost_registry: InpostRegistry, config: dict):
     logger = logging.getLogger(__name__)
-    client = TelegramClient(**config['telethon_settings'])
-    print("Starting")
-
-    if not config['bot_token']:
-        raise Exception('No bot token provided')
-
-    await client.start(bot_token=config['bot_token'])
-    print("Started")
 
     @client.on(CallbackQuery(pattern='Me'))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
     async def get_me(event):
-        if not user_exists(userid=event.sender.id):
-            await event.reply('You are not initialized')
+        if not await user_exists(userid=event.sender.id):
+            await outbox.reply(event, 'You are not initialized')
             return
 
-        await event.reply('Sorry, it is not implemented yet :<')
+        await outbox.reply(event, 'Sorry, it is not implemented yet :<')
 
         # for phone_number in PhoneNumberConfig.select(user=event.sender.id):
         #     await event.reply(
@@ -49,199 +53,236 @@ async def main(config):
         #         f'\n**Air quality**: `{phone_number.airquality}`')
 
     @client.on(NewMessage(func=lambda e: e.text.startswith('/init') or e.message.contact is not None))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
     async def init_user(event):
-        with db_session:
-            async with client.conversation(event.sender.id) as convo:
-                prefix, phone_number = await init_phone_number(event=event)
-                try:
-                    if phone_number is None is prefix:
-                        await convo.send_message(
-                            'Something is wrong with provided phone number. Start initialization again.',
+        async with client.conversation(event.sender.id) as convo:
+            prefix, phone_number = await init_phone_number(event=event)
+            try:
+                if phone_number is None is prefix:
+                    await outbox.send_message(convo,
+                        'Something is wrong with provided phone number. Start initialization again.',
+                        buttons=Button.clear())
+                    convo.cancel()
+                    return
+
+                if not await user_exists(userid=event.sender.id):
+                    await add_user(event=event)
+
+                owner = await get_phone_number_owner(phone_number=phone_number)
+
+                if owner is not None:
+                    if not event.sender.id == owner:
+                        await outbox.send_message(convo,
+                            "Phone number already exist and you are not it's owner, cancelling!",
                             buttons=Button.clear())
                         convo.cancel()
                         return
 
-                    if not user_exists(userid=event.sender.id):
-                        add_user(event=event)
+                    await outbox.send_message(convo,
+                        'You have initialized this phone number before, do you want to do it again? '
+                        'All defaults remains!', buttons=[Button.inline('Do it'), Button.inline('Cancel')])
+                    resp = await convo.wait_event(CallbackQuery())
 
-                    pn: PhoneNumberConfig = PhoneNumberConfig.get(phone_number=phone_number)
-
-                    if pn is not None:
-                        if not event.sender.id == pn.user.userid:
-                            await convo.send_message(
-                                "Phone number already exist and you are not it's owner, cancelling!",
-                                buttons=Button.clear())
+                    match resp.data:
+                        case b'Do it':
+                            await outbox.reply(resp, 'Fine, moving on to sending sms code!')
+                        case b'Cancel':
+                            await outbox.reply(resp, 'Fine, cancelling!')
                             convo.cancel()
                             return
 
-                        await convo.send_message(
-                            'You have initialized this phone number before, do you want to do it again? '
-                            'All defaults remains!', buttons=[Button.inline('Do it'), Button.inline('Cancel')])
-                        resp = await convo.wait_event(CallbackQuery())
-
-                        match resp.data:
-                            case b'Do it':
-                                await resp.reply('Fine, moving on to sending sms code!')
-                            case b'Cancel':
-                                await resp.reply('Fine, cancelling!')
-                                convo.cancel()
-                                return
-
-                    else:
-                        add_phone_number_config(event=event, prefix=prefix, phone_number=phone_number)
+                else:
+                    await add_phone_number_config(event=event, prefix=prefix, phone_number=phone_number)
 
-                        if count(s for s in PhoneNumberConfig if s.user.userid == event.sender.id) == 1:
-                            edit_default_phone_number(event=event, default_phone_number=phone_number)
+                    if await count_user_phone_numbers(userid=event.sender.id) == 1:
+                        await edit_default_phone_number(event=event, default_phone_number=phone_number)
 
-                    inp = Inpost(**get_inpost_obj(userid=event.sender.id, phone_number=phone_number))
+                inp = await inpost_registry.get(userid=event.sender.id, phone_number=phone_number)
 
-                    if not await inp.send_sms_code():
-                        await convo.send_message('Could not send sms code! Start initializing again!',
-                                                 buttons=Button.clear())
+                if not await inp.send_sms_code():
+                    await outbox.send_message(convo, 'Could not send sms code! Start initializing again!',
+                                              buttons=Button.clear())
 
-                        return
+                    return
 
-                    await convo.send_message('Phone number accepted, send me sms code that InPost '
-                                             'sent to provided phone number! You have 60 seconds from now!',
-                                             buttons=Button.clear())
-                    sms_code = await convo.get_response(timeout=60)
+                await outbox.send_message(convo, 'Phone number accepted, send me sms code that InPost '
+                                          'sent to provided phone number! You have 60 seconds from now!',
+                                          buttons=Button.clear())
+                sms_code = await convo.get_response(timeout=60)
 
-                    if not (len(sms_code.text.strip()) == 6 and sms_code.text.strip().isdigit()):
-                        await convo.send_message(
-                            'Something is wrong with provided sms code! Start initialization again.',
-                            buttons=Button.clear())
+                if not (len(sms_code.text.strip()) == 6 and sms_code.text.strip().isdigit()):
+                    await outbox.send_message(convo,
+                        'Something is wrong with provided sms code! Start initialization again.',
+                        buttons=Button.clear())
 
-                        return
-
-                    if not await inp.confirm_sms_code(sms_code=sms_code.text.strip()):
-                        await convo.send_message('Something went wrong! Start initialization again.',
-                                                 buttons=Button.clear())
+                    return
 
-                        return
+                if not await inp.confirm_sms_code(sms_code=sms_code.text.strip()):
+                    await outbox.send_message(convo, 'Something went wrong! Start initialization again.',
+                                              buttons=Button.clear())
 
-                    edit_phone_number_config(event=event,
-                                             phone_number=phone_number,
-                                             sms_code=sms_code.text.strip(),
-                                             refr_token=inp.refr_token,
-                                             auth_token=inp.auth_token)
-                    await convo.send_message(
-                        f'Congrats, you have successfully verified yourself. '
-                        f'If this was your first time, `{prefix} {phone_number}` is now your default one!'
-                        f'\n\nHave fun using InPost services there!', buttons=Button.clear())
                     return
 
-                except asyncio.TimeoutError as e:
-                    logger.exception(e)
-                    await convo.send_message('Time has ran out, start initialization again!')
-                    convo.cancel()
-                except PhoneNumberError as e:
-                    logger.exception(e)
-                    await convo.send_message(e.reason)
-                except UnauthorizedError as e:
-                    logger.exception(e)
-                    await convo.send_message('You are not authorized')
-                except UnidentifiedAPIError as e:
-                    logger.exception(e)
-                    await convo.send_message('Unexpected error occurred, call admin')
-                except Exception as e:
-                    logger.exception(e)
-                    await convo.send_message('Bad things happened, call admin now!')
-                finally:
-                    convo.cancel()
-                    await inp.sess.close()
-                    del inp
-                    return
+                await edit_phone_number_config(event=event,
+                                               phone_number=phone_number,
+                                               sms_code=sms_code.text.strip(),
+                                               refr_token=inp.refr_token,
+                                               auth_token=inp.auth_token)
+                inpost_registry.tokens_stored(userid=event.sender.id, phone_number=phone_number, inp=inp)
+                await outbox.send_message(convo,
+                    f'Congrats, you have successfully verified yourself. '
+                    f'If this was your first time, `{prefix} {phone_number}` is now your default one!'
+                    f'\n\nHave fun using InPost services there!', buttons=Button.clear())
+                return
+
+            except asyncio.TimeoutError as e:
+                logger.exception(e)
+                await outbox.send_message(convo, 'Time has ran out, start initialization again!')
+                convo.cancel()
+            except PhoneNumberError as e:
+                logger.exception(e)
+                await outbox.send_message(convo, e.reason)
+            except UnauthorizedError as e:
+                logger.exception(e)
+                await outbox.send_message(convo, 'You are not authorized')
+            except UnidentifiedAPIError as e:
+                logger.exception(e)
+                await outbox.send_message(convo, 'Unexpected error occurred, call admin')
+            except Exception as e:
+                logger.exception(e)
+                await outbox.send_message(convo, 'Bad things happened, call admin now!')
+            finally:
+                convo.cancel()
+                return
 
     @client.on(NewMessage(pattern='/start'))
     @client.on(NewMessage(pattern='/help'))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
     async def start(event):
-        await event.reply(welcome_message, buttons=[Button.request_phone('Log in via Telegram')])
+        await outbox.reply(event, welcome_message, buttons=[Button.request_phone('Log in via Telegram')])
 
     @client.on(NewMessage(pattern='/clear'))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
     async def clear(event):
-        await event.reply('You are welcome :D', buttons=Button.clear())
+        await outbox.reply(event, 'You are welcome :D', buttons=Button.clear())
+
+    @client.on(NewMessage(pattern='/profile'))
+    async def profile(event):
+        if event.sender_id not in config.get('admins', []):
+            return
+
+        try:
+            seconds = float(event.raw_text.split()[1]) if len(event.raw_text.split()) > 1 else 10
+        except ValueError:
+            await outbox.reply(event, 'Usage: /profile [seconds]')
+            return
+
+        await outbox.reply(event, f'Profiling for {min(seconds, tracer.max_profile_seconds)}s...')
+        try:
+            path, summary = await tracer.profile(seconds)
+        except RuntimeError as e:
+            await outbox.reply(event, str(e))
+            return
+
+        await outbox.reply(event, f'Profile written to `{path}`\n\n```{summary[:3500]}```')
 
     @client.on(NewMessage(pattern='/menu'))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
     async def send_menu(event):
-        if not user_exists(userid=event.sender.id):
-            await event.reply('You are not initialized')
+        if not await user_exists(userid=event.sender.id):
+            await outbox.reply(event, 'You are not initialized')
             return
 
-        await event.reply('Hello, what you want to do? :)',
+        await outbox.reply(event, 'Hello, what you want to do? :)',
                           buttons=[[Button.inline('Parcels'), Button.inline('Friends')],
                                    [Button.inline('Me'), Button.inline('Consent')]])
 
     @client.on(CallbackQuery(pattern=b'Parcels'))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
     async def send_menu_parcels(event):
-        if not user_exists(userid=event.sender.id):
-            await event.reply('You are not initialized')
+        if not await user_exists(userid=event.sender.id):
+            await outbox.reply(event, 'You are not initialized')
             return
 
-        await event.reply('Select parcel type',
-                          buttons=[[Button.inline('Pending'), Button.inline('Sent')],
-                                   [Button.inline('Returns'), Button.inline('All')],
-                                   [Button.inline('From shipment number')]
-                                   ])
+        await outbox.reply(event, 'Select parcel type',
+                           buttons=[[Button.inline('Pending'), Button.inline('Sent')],
+                                    [Button.inline('Returns'), Button.inline('All')],
+                                    [Button.inline('From shipment number')]
+                                    ])
 
     @client.on(CallbackQuery(pattern=b'Friends'))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
     async def send_menu_friends(event):
-        if not user_exists(userid=event.sender.id):
-            await event.reply('You are not initialized')
+        if not await user_exists(userid=event.sender.id):
+            await outbox.reply(event, 'You are not initialized')
             return
 
-        await event.reply('Sorry, it is not implemented yet :<')
+        await outbox.reply(event, 'Sorry, it is not implemented yet :<')
 
     @client.on(CallbackQuery(pattern='From shipment number'))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
     async def get_parcel(event):
-        if not user_exists(userid=event.sender.id):
-            await event.reply('You are not initialized')
+        if not await user_exists(userid=event.sender.id):
+            await outbox.reply(event, 'You are not initialized')
             return
 
         async with client.conversation(event.sender.id) as convo:
             try:
-                if count_user_phone_numbers(userid=event.sender.id) == 1:
-                    phone_number = get_default_phone_number(userid=event.sender.id).phone_number
+                if await count_user_phone_numbers(userid=event.sender.id) == 1:
+                    phone_number = (await get_default_phone_number(userid=event.sender.id)).phone_number
                 else:
-                    await convo.send_message('Please choose phone number',
-                                             buttons=[Button.inline(f'{phone.phone_number}') for phone in
-                                                      get_user_phone_numbers(userid=event.sender.id)])
+                    await outbox.send_message(convo, 'Please choose phone number',
+                                              buttons=[Button.inline(f'{phone.phone_number}') for phone in
+                                                       await get_user_phone_numbers(userid=event.sender.id)])
 
                     phone_number = await convo.wait_event(event=CallbackQuery(), timeout=30)
                     phone_number = phone_number.data.decode("utf-8")
 
-                await convo.send_message('Please send me a shipment number within 60 seconds')
+                await outbox.send_message(convo, 'Please send me a shipment number within 60 seconds')
                 shipment_number = await convo.wait_event(event=NewMessage(), timeout=60)
 
             except asyncio.TimeoutError as e:
                 logger.exception(e)
-                await convo.send_message('Time has ran out, please start opening compartment again!')
+                await outbox.send_message(convo, 'Time has ran out, please start opening compartment again!')
                 convo.cancel()
 
                 return
 
             try:
-                inp = Inpost(**get_inpost_obj(userid=event.sender.id, phone_number=phone_number))
+                inp = await inpost_registry.get(userid=event.sender.id, phone_number=phone_number)
                 await send_pcg(shipment_number, inp, phone_number, ParcelType.TRACKED)
 
             except NotAuthenticatedError as e:
                 logger.exception(e)
-                await event.reply(e.reason)
+                await outbox.reply(event, e.reason)
             except UnauthorizedError as e:
                 logger.exception(e)
-                await event.reply('You are not authorized, initialize first!')
+                await outbox.reply(event, 'You are not authorized, initialize first!')
             except NotFoundError as e:
                 logger.exception(e)
-                await event.reply('This parcel does not exist or does not belong to you!')
+                await outbox.reply(event, 'This parcel does not exist or does not belong to you!')
             except UnidentifiedAPIError as e:
                 logger.exception(e)
-                await event.reply('Unexpected exception occurred, call admin')
+                await outbox.reply(event, 'Unexpected exception occurred, call admin')
             except Exception as e:
                 logger.exception(e)
-                await event.reply('Bad things happened, call admin now!')
+                await outbox.reply(event, 'Bad things happened, call admin now!')
             finally:
                 convo.cancel()
-                await inp.sess.close()
-                del inp
                 return
 
     @client.on(CallbackQuery(pattern=b'Pending'))
@@ -249,123 +290,155 @@ async def main(config):
     @client.on(CallbackQuery(pattern=b'Sent'))
     @client.on(CallbackQuery(pattern=b'Returns'))
     @client.on(CallbackQuery(pattern=b'All'))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
     async def get_packages(event):
-        if not user_exists(userid=event.sender.id):
-            await event.reply('You are not initialized')
+        if not await user_exists(userid=event.sender.id):
+            await outbox.reply(event, 'You are not initialized')
             return
 
-        match event.data:
-            case b'Pending':
-                status = pending_statuses
-                parcel_type = ParcelType.TRACKED
-            case b'Delivered':
-                status = ParcelStatus.DELIVERED
-                parcel_type = ParcelType.TRACKED
-            case b'Sent':
-                status = None
-                parcel_type = ParcelType.SENT
-            case b'Returns':
-                status = None
-                parcel_type = ParcelType.RETURNS
-            case b'All':
-                status = None
-                parcel_type = ParcelType.TRACKED
-            case _:
-                await event.reply('Unreckognized option selected')
-                return
+        if (list_filter := event.data.decode('utf-8')) not in parcel_list_filters:
+            await outbox.reply(event, 'Unreckognized option selected')
+            return
 
         async with client.conversation(event.sender.id) as convo:
             try:
-                if count_user_phone_numbers(userid=event.sender.id) == 1:
-                    phone_number = get_default_phone_number(userid=event.sender.id).phone_number
+                if await count_user_phone_numbers(userid=event.sender.id) == 1:
+                    phone_number = (await get_default_phone_number(userid=event.sender.id)).phone_number
                 else:
-                    await convo.send_message('Please choose phone number',
-                                             buttons=[Button.inline(f'{phone.phone_number}') for phone in
-                                                      get_user_phone_numbers(userid=event.sender.id)])
+                    await outbox.send_message(convo, 'Please choose phone number',
+                                              buttons=[Button.inline(f'{phone.phone_number}') for phone in
+                                                       await get_user_phone_numbers(userid=event.sender.id)])
 
                     phone_number = await convo.wait_event(event=CallbackQuery(), timeout=30)
                     phone_number = phone_number.data.decode("utf-8").strip()
 
-                inp = Inpost(**get_inpost_obj(userid=event.sender.id, phone_number=phone_number))
+                inp = await inpost_registry.get(userid=event.sender.id, phone_number=phone_number)
 
-                await send_pcgs(event, inp, status, phone_number, parcel_type)
+                await send_pcgs(event, inp, list_filter, phone_number,
+                                page_size=config.get('parcel_list_page_size', 5),
+                                multicompartment_concurrency=config.get('multicompartment_concurrency', 5))
 
             except asyncio.TimeoutError as e:
                 logger.exception(e)
-                await convo.send_message('Time has ran out, please start opening compartment again!',
-                                         buttons=[Button.clear()])
+                await outbox.send_message(convo, 'Time has ran out, please start opening compartment again!',
+                                          buttons=[Button.clear()])
 
             except (NotAuthenticatedError, ParcelTypeError) as e:
                 logger.exception(e)
-                await event.reply(e.reason)
+                await outbox.reply(event, e.reason)
             except UnauthorizedError as e:
                 logger.exception(e)
-                await event.reply('You are not authorized, initialize first!')
+                await outbox.reply(event, 'You are not authorized, initialize first!')
             except NotFoundError:
-                await event.reply('No parcels found!')
+                await outbox.reply(event, 'No parcels found!')
             except UnidentifiedAPIError as e:
                 logger.exception(e)
-                await event.reply('Unexpected error occurred, call admin')
+                await outbox.reply(event, 'Unexpected error occurred, call admin')
             except Exception as e:
                 logger.exception(e)
-                await event.reply('Bad things happened, call admin now!')
+                await outbox.reply(event, 'Bad things happened, call admin now!')
             finally:
                 convo.cancel()
-                await inp.sess.close()
-                del inp
                 return
 
+    @client.on(CallbackQuery(pattern=b'List:'))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
+    async def turn_parcel_list_page(event):
+        _, list_filter, phone_number, page = event.data.decode('utf-8').split(':')
+        try:
+            inp = await inpost_registry.get(userid=event.sender.id, phone_number=phone_number)
+            await send_pcgs(event, inp, list_filter, phone_number, page=int(page), edit=True,
+                            page_size=config.get('parcel_list_page_size', 5),
+                            multicompartment_concurrency=config.get('multicompartment_concurrency', 5))
+
+        except (NotAuthenticatedError, ParcelTypeError) as e:
+            logger.exception(e)
+            await event.answer(e.reason, alert=True)
+        except UnauthorizedError as e:
+            logger.exception(e)
+            await event.answer('You are not authorized, initialize first!', alert=True)
+        except NotFoundError:
+            await event.answer('No parcels found!', alert=True)
+        except UnidentifiedAPIError as e:
+            logger.exception(e)
+            await event.answer('Unexpected error occurred, call admin', alert=True)
+        except Exception as e:
+            logger.exception(e)
+            await event.answer('Bad things happened, call admin now!', alert=True)
+
+    @client.on(CallbackQuery(pattern=PARCEL_CALLBACK_MAGIC))
     @client.on(CallbackQuery(pattern=b'Open Code'))
     @client.on(CallbackQuery(pattern=b'QR Code'))
     @client.on(CallbackQuery(pattern=b'Details'))
     @client.on(CallbackQuery(pattern=b'Share'))
     @client.on(CallbackQuery(pattern=b'Open Compartment'))
+    @metrics.handler
+    @tracer.handler
+    @recorder.handler
     async def handle_parcel(event):
         async with client.conversation(event.sender.id) as convo:
             try:
-                shipment_number = await get_shipment_number_from_button(event)
-                raw_parcel = get_user_last_parcel_with_shipment_number(event.sender.id, shipment_number)
-                inp = Inpost(**get_inpost_obj(userid=event.sender.id,
-                                              phone_number=raw_parcel.phone_number.phone_number))
-                parcel = Parcel(raw_parcel.parcel, logging.getLogger('Inpost'))
-                match event.data:
-                    case b'Open Code':
+                if event.data.startswith(PARCEL_CALLBACK_MAGIC):
+                    action, parcel_type, phone_number, shipment_number = decode_parcel_callback(event.data)
+                    inp = await inpost_registry.get(userid=event.sender.id, phone_number=phone_number)
+                    if action == ParcelAction.SHOW:
+                        await send_pcg(event, inp, phone_number, parcel_type, shipment_number=shipment_number)
+                        await event.answer()
+                        return
+
+                    parcel, raw = await get_known_parcel(inp=inp, userid=event.sender.id,
+                                                         shipment_number=shipment_number, parcel_type=parcel_type)
+                else:
+                    action = legacy_parcel_actions[event.data]
+                    shipment_number = await get_shipment_number_from_button(event)
+                    raw_parcel = await get_user_last_parcel_with_shipment_number(event.sender.id, shipment_number)
+                    if raw_parcel is None:
+                        await event.answer('This parcel is not known yet, list your parcels again!', alert=True)
+                        return
+
+                    inp = await inpost_registry.get(userid=event.sender.id,
+                                                    phone_number=raw_parcel.phone_number.phone_number)
+                    parcel_type = ParcelType[raw_parcel.ptype]
+                    raw = raw_parcel.parcel
+                    parcel = Parcel(raw, logging.getLogger('Inpost'))
+
+                match action:
+                    case ParcelAction.OPEN_CODE:
                         await show_oc(event, parcel, inp)
-                    case b'QR Code':
-                        await send_qrc(event, parcel, inp)
-                    case b'Details':
+                    case ParcelAction.QR_CODE:
+                        await send_qrc(event, parcel, inp, raw)
+                    case ParcelAction.DETAILS:
                         await send_details(event, inp, parcel)
-                    case b'Share':
+                    case ParcelAction.SHARE:
                         await share_parcel(event, convo, inp, parcel.shipment_number)
-                    case b'Open Compartment':
-                        await open_compartment(event, convo, inp, parcel, ParcelType[raw_parcel.ptype])
-                    case _:
-                        await convo.send_message('Time has ran out, please start opening compartment again!',
-                                                 buttons=[Button.clear()])
+                    case ParcelAction.OPEN_COMPARTMENT:
+                        await open_compartment(event, convo, inp, parcel, parcel_type)
 
             except asyncio.TimeoutError as e:
                 logger.exception(e)
-                await convo.send_message('Time has ran out, please start opening compartment again!',
-                                         buttons=[Button.clear()])
+                await outbox.send_message(convo, 'Time has ran out, please start opening compartment again!',
+                                          buttons=[Button.clear()])
 
             except (NotAuthenticatedError, ParcelTypeError) as e:
                 logger.exception(e)
-                await event.reply(e.reason)
+                await outbox.reply(event, e.reason)
             except UnauthorizedError as e:
                 logger.exception(e)
-                await event.reply('You are not authorized, initialize first!')
+                await outbox.reply(event, 'You are not authorized, initialize first!')
             except NotFoundError:
-                await event.reply('No parcels found!')
+                await outbox.reply(event, 'No parcels found!')
             except UnidentifiedAPIError as e:
                 logger.exception(e)
-                await event.reply('Unexpected error occurred, call admin')
+                await outbox.reply(event, 'Unexpected error occurred, call admin')
             except Exception as e:
                 logger.exception(e)
-                await event.reply('Bad things happened, call admin now!')
+                await outbox.reply(event, 'Bad things happened, call admin now!')
             finally:
                 convo.cancel()
-                await inp.sess.close()
-                del inp
                 return
 
     # @client.on(NewMessage(pattern='/friends'))
@@ -585,9 +658,82 @@ async def main(config):
     #     await event.reply(f'Notifications are set to {msg.upper()}!')
     #
 
+
+async def main(config):
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=config['log_level'])
+    logging.getLogger().addHandler(ErrorCounter())
+    client = TelegramClient(**config['telethon_settings'])
+    token_manager = TokenManager(**config.get('token_manager', {}))
+    inpost_registry = InpostRegistry(token_manager=token_manager, **config.get('inpost_settings', {}))
+    print("Starting")
+
+    if not config['bot_token']:
+        raise Exception('No bot token provided')
+
+    await client.start(bot_token=config['bot_token'])
+    print("Started")
+
+    # until known users are loaded, user_exists falls back to database
+    background_tasks = [asyncio.create_task(token_manager.run(clients=inpost_registry.clients)),
+                        asyncio.create_task(load_known_users(**config.get('known_users', {}))),
+                        asyncio.create_task(load_pickup_points())]
+    if (compaction := config.get('parcel_data_compaction', {})).get('enabled', False):
+        background_tasks.append(asyncio.create_task(run_parcel_data_compaction(
+            interval=compaction.get('interval', 86400),
+            retention_days=compaction.get('retention_days'),
+            batch_size=compaction.get('batch_size', 500))))
+
+    notifier = lease_manager = None
+    if (poller := config.get('notification_poller', {})).get('enabled', False):
+        if (sharding := config.get('sharding', {})).get('enabled', False):
+            lease_manager = LeaseManager(**{k: v for k, v in sharding.items() if k != 'enabled'})
+
+        notifier = ParcelNotifier(client=client, registry=inpost_registry, lease_manager=lease_manager,
+                                  **{k: v for k, v in poller.items() if k != 'enabled'})
+        background_tasks.append(asyncio.create_task(notifier.run()))
+
+        if lease_manager is not None:
+            lease_manager.stats = notifier.stats
+            background_tasks.append(asyncio.create_task(lease_manager.run()))
+
+    # telethon keeps open conversations per chat in private attribute, there is no public accessor
+    metrics.gauge('active_conversations', 'Conversations waiting for user input',
+                  lambda: sum(len(conversations) for conversations in client._conversations.values()))
+    metrics.gauge('database_queue_depth', 'Database calls waiting for executor', lambda: executor.queue_depth)
+    metrics.gauge('outbox_queue_depth', 'Messages waiting in outbox', lambda: outbox.queue_depth)
+    metrics.gauge('known_users', 'Registered users kept in memory index', lambda: len(known_users))
+    metrics.gauge('pickup_points', 'Pickup points in catalogue', lambda: len(pickup_points))
+    metrics.gauge('inpost_clients', 'Inpost clients kept in registry', lambda: len(inpost_registry.clients()))
+
+    metrics_server = None
+    if (metrics_config := config.get('metrics', {})).get('enabled', False):
+        metrics_server = MetricsServer(**{k: v for k, v in metrics_config.items() if k != 'enabled'})
+        await metrics_server.start()
+
+    register_handlers(client=client, inpost_registry=inpost_registry, config=config)
+
     async with client:
         print("Good morning!")
-        await client.run_until_disconnected()
+        try:
+            await client.run_until_disconnected()
+        finally:
+            for task in background_tasks:
+                task.cancel()
+
+            if notifier is not None:
+                await notifier.close()
+
+            if lease_manager is not None:
+                await lease_manager.close()
+
+            if metrics_server is not None:
+                await metrics_server.close()
+
+            recorder.close()
+            pickup_points.save()
+            await outbox.close()
+            await inpost_registry.close()
+            executor.shutdown()
 
 
 if __name__ == '__main__':
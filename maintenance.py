@@ -0,0 +1,25 @@
+import asyncio
+import logging
+
+import async_database
+import database
+
+
+async def run_parcel_data_compaction(interval: int = 86400, retention_days: int | None = None,
+                                     batch_size: int = 500):
+    logger = logging.getLogger(__name__)
+    while True:
+        try:
+            report = await async_database.compact_parcel_data(retention_days=retention_days, batch_size=batch_size)
+            logger.info(f'parcel data compacted: {report["deduplicated_rows"]} duplicated and '
+                        f'{report["expired_rows"]} expired rows removed, {report["reclaimed_bytes"]} bytes reclaimed')
+        except Exception as e:
+            logger.exception(e)
+
+        await asyncio.sleep(interval)
+
+
+if __name__ == '__main__':
+    settings = database.config.get('parcel_data_compaction', {})
+    print(database.compact_parcel_data(retention_days=settings.get('retention_days'),
+                                       batch_size=settings.get('batch_size', 500)))
@@ -0,0 +1,166 @@
+import logging
+import re
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+from typing import Callable, Dict, List, Tuple
+
+from aiohttp import web
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...] = default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Minimal in-process metrics registry rendered in prometheus text exposition format"""
+
+    def __init__(self):
+        self._help: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self._histograms: Dict[str, Dict[Tuple[Tuple[str, str], ...], Histogram]] = defaultdict(dict)
+        self._counters: Dict[str, Dict[Tuple[Tuple[str, str], ...], float]] = defaultdict(lambda: defaultdict(float))
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        if (histogram := self._histograms[name].get(key)) is None:
+            histogram = self._histograms[name][key] = Histogram()
+
+        histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        self._counters[name][tuple(sorted(labels.items()))] += value
+
+    def gauge(self, name: str, help_text: str, func: Callable[[], float]):
+        """Registers gauge which value is read from func on every scrape"""
+        self.describe(name, 'gauge', help_text)
+        self._gauges[name] = func
+
+    def timed(self, name: str, **labels: str):
+        """Decorates coroutine function, so its duration lands in `name` histogram"""
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started, **labels)
+
+            return wrapper
+
+        return decorator
+
+    def handler(self, func):
+        """Times telegram update handler, labelled with its name"""
+        return self.timed('handler_duration_seconds', handler=func.__name__)(func)
+
+    @staticmethod
+    def _labels(key: Tuple[Tuple[str, str], ...], extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+        pairs = [f'{k}="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+                 for k, v in key + extra]
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for name in sorted(set(self._histograms) | set(self._counters) | set(self._gauges)):
+            kind, help_text = self._help.get(name, ('untyped', name))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+            for key, histogram in self._histograms.get(name, {}).items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f'{bound}'
+                    lines.append(f'{name}_bucket{self._labels(key, (("le", le),))} {cumulative}')
+
+                lines.append(f'{name}_sum{self._labels(key)} {histogram.sum}')
+                lines.append(f'{name}_count{self._labels(key)} {histogram.count}')
+
+            for key, value in self._counters.get(name, {}).items():
+                lines.append(f'{name}{self._labels(key)} {value}')
+
+            if name in self._gauges:
+                try:
+                    lines.append(f'{name} {float(self._gauges[name]())}')
+                except Exception as e:
+                    logging.getLogger(self.__class__.__name__).warning(f'could not read gauge {name}: {e}')
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('handler_duration_seconds', 'histogram', 'Time spent in telegram update handlers')
+metrics.describe('inpost_request_duration_seconds', 'histogram', 'Inpost API request latency by action')
+metrics.describe('database_call_duration_seconds', 'histogram', 'Database call latency including executor queue')
+metrics.describe('errors_total', 'counter', 'Logged exceptions by type')
+
+
+class ErrorCounter(logging.Handler):
+    """Counts every exception that gets logged, handlers catch and log them instead of letting them escape"""
+
+    def emit(self, record: logging.LogRecord):
+        if record.exc_info and record.exc_info[0] is not None:
+            metrics.inc('errors_total', type=record.exc_info[0].__name__, logger=record.name)
+
+
+def _action_label(action: str) -> str:
+    # some actions end with shipment number or uuid, which would create new series for every parcel
+    return re.sub(r'( number| uuid| for|:) \S+$', r'\1', action)
+
+
+def instrument_inpost(inp):
+    """Times every request of Inpost client, all its API methods go through `request` with `action` describing it"""
+    request = inp.request
+
+    @wraps(request)
+    async def timed_request(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await request(*args, **kwargs)
+        finally:
+            metrics.observe('inpost_request_duration_seconds', time.perf_counter() - started,
+                            action=_action_label(kwargs.get('action', 'unknown')))
+
+    inp.request = timed_request
+    return inp
+
+
+class MetricsServer:
+    def __init__(self, host: str = '127.0.0.1', port: int = 9100, path: str = '/metrics'):
+        self.host = host
+        self.port = port
+        self.path = path
+        self._runner: web.AppRunner | None = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get(self.path, self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host=self.host, port=self.port).start()
+        logging.getLogger(self.__class__.__name__).info(f'serving metrics on http://{self.host}:{self.port}{self.path}')
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
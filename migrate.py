@@ -0,0 +1,256 @@
+"""Streams data into database of config.yml in batches, so large databases are moved with bounded memory.
+
+Copy users, phone numbers, parcel history and QR code media from database described in another config, e.g. from
+SQLite to Postgres or the other way round:
+
+    python migrate.py copy old-config.yml
+
+Migrate database of old bot versions, which kept single phone number per user in one table:
+
+    python migrate.py legacy /path/to/old.sqlite
+
+Source is read with keyset pagination, every batch is written with one bulk insert in its own transaction and
+progress is saved to checkpoint file afterwards. Interrupted migration is resumed by running the same command again.
+Rows already present in target are skipped, so batch repeated after crash is not inserted twice.
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import yaml
+from pony.orm import Database, Json, commit, db_session
+
+import database
+
+# referenced tables go first, shard leases and workers are runtime state of running bot, so they are not copied
+TABLES = ('User', 'PhoneNumberConfig', 'ParcelData', 'QRCodeMedia')
+
+
+class Checkpoint:
+    """Last copied key of every table, saved to JSON file after each committed batch"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._state: Dict[str, dict] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._state = json.load(f)
+
+    def last_key(self, table: str):
+        return self._state.get(table, {}).get('last_key')
+
+    def rows(self, table: str) -> int:
+        return self._state.get(table, {}).get('rows', 0)
+
+    def done(self, table: str) -> bool:
+        return self._state.get(table, {}).get('done', False)
+
+    def save(self, table: str, last_key=None, rows: int = 0, done: bool = False):
+        self._state[table] = {'last_key': last_key if last_key is not None else self.last_key(table),
+                              'rows': rows, 'done': done}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self._state, f)
+
+        os.replace(self.path + '.tmp', self.path)  # checkpoint is never left half written
+
+
+class Progress:
+    def __init__(self, table: str, rows: int, interval: float = 1.0):
+        self.table = table
+        self.rows = rows
+        self.resumed = rows
+        self.interval = interval
+        self.started = self.reported = time.perf_counter()
+
+    def rate(self) -> float:
+        return (self.rows - self.resumed) / max(time.perf_counter() - self.started, 1e-9)
+
+    def update(self, rows: int):
+        self.rows += rows
+        if time.perf_counter() - self.reported >= self.interval:
+            self.reported = time.perf_counter()
+            print(f'{self.table}: {self.rows} rows, {self.rate():.0f} rows/s')
+
+    def finish(self):
+        print(f'{self.table}: done, {self.rows} rows, {self.rate():.0f} rows/s')
+
+
+def check_provider(db: Database):
+    # ON CONFLICT DO NOTHING makes repeated batches harmless, only these two support it the same way
+    if db.provider.dialect not in ('SQLite', 'PostgreSQL'):
+        raise SystemExit(f'{db.provider.dialect} is not supported, only SQLite and PostgreSQL are')
+
+
+def read_batch(db: Database, table: str, columns: List[str], key: str, after, batch_size: int) -> List[tuple]:
+    quote = db.provider.quote_name
+    sql = f'SELECT {", ".join(quote(column) for column in columns)} FROM {quote(table)} ' + \
+          (f'WHERE {quote(key)} > $after ' if after is not None else '') + \
+          f'ORDER BY {quote(key)} LIMIT $batch_size'
+    return db.execute(sql, {'after': after, 'batch_size': batch_size}).fetchall()
+
+
+def insert_rows(db: Database, table: str, columns: List[str], rows: List[tuple]):
+    quote = db.provider.quote_name
+    sql = f'INSERT INTO {quote(table)} ({", ".join(quote(column) for column in columns)}) VALUES '
+    cursor = db.get_connection().cursor()
+    if db.provider.dialect == 'PostgreSQL':
+        from psycopg2.extras import execute_values  # single statement per batch instead of one per row
+
+        execute_values(cursor, sql + '%s ON CONFLICT DO NOTHING', rows, page_size=len(rows))
+    else:
+        cursor.executemany(sql + f'({", ".join("?" * len(columns))}) ON CONFLICT DO NOTHING', rows)
+
+
+def convert(value, py_type):
+    """Normalizes values read by one database driver, so the other one accepts them"""
+    if value is None:
+        return None
+    if py_type is bool:  # SQLite stores booleans as integers
+        return bool(value)
+    if py_type is Json:  # SQLite returns JSON as text, Postgres as decoded objects
+        return value if isinstance(value, str) else json.dumps(value)
+    if py_type is bytes:
+        return bytes(value)
+    if py_type is datetime:
+        return value if isinstance(value, str) else str(value)
+
+    return value
+
+
+def table_columns(entity) -> List[Tuple[str, type]]:
+    return [(column, attr.py_type) for attr in entity._attrs_ for column in attr.columns]
+
+
+def insert_entities(entity, rows: List[dict]):
+    """Inserts rows given as column -> value, missing optional strings are empty like Pony stores them"""
+    columns = [(column, attr) for attr in entity._attrs_ for column in attr.columns]
+    insert_rows(database.db, entity._table_, [column for column, _ in columns],
+                [tuple('' if row.get(column) is None and attr.py_type is str and not attr.nullable else
+                       row.get(column) for column, attr in columns) for row in rows])
+
+
+def reset_sequence(db: Database, table: str, key: str):
+    # copied ids do not advance serial sequence of Postgres, next parcel would collide with them
+    if db.provider.dialect == 'PostgreSQL':
+        quote = db.provider.quote_name
+        db.execute(f"SELECT setval(pg_get_serial_sequence('{quote(table)}', '{key}'), "
+                   f"COALESCE((SELECT MAX({quote(key)}) FROM {quote(table)}), 1))")
+
+
+def copy_table(source: Database, entity, checkpoint: Checkpoint, batch_size: int):
+    table, (key,) = entity._table_, entity._pk_columns_
+    if checkpoint.done(table):
+        print(f'{table}: already copied, skipping')
+        return
+
+    columns, types = zip(*table_columns(entity))
+    source_table = source.provider.normalize_name(table)
+    key_index = columns.index(key)
+    after = checkpoint.last_key(table)
+    progress = Progress(table, checkpoint.rows(table))
+
+    while True:
+        with db_session:
+            batch = read_batch(source, source_table, list(columns), key, after, batch_size)
+            if batch:
+                insert_rows(database.db, table, list(columns),
+                             [tuple(convert(value, py_type) for value, py_type in zip(row, types)) for row in batch])
+            elif any(attr.auto for attr in entity._pk_attrs_):
+                reset_sequence(database.db, table, key)
+
+            commit()
+
+        if not batch:
+            checkpoint.save(table, rows=progress.rows, done=True)
+            progress.finish()
+            return
+
+        after = batch[-1][key_index]
+        progress.update(len(batch))
+        checkpoint.save(table, last_key=after, rows=progress.rows)
+
+
+def copy(args: argparse.Namespace):
+    with open(args.source) as f:
+        settings = yaml.safe_load(f)['database_settings']
+
+    # Pony resolves relative SQLite paths against directory of calling module, not current one
+    if settings.get('provider') == 'sqlite' and settings.get('filename', ':memory:') != ':memory:':
+        settings['filename'] = os.path.abspath(settings['filename'])
+
+    source = Database(**settings)
+    check_provider(source)
+    check_provider(database.db)
+    checkpoint = Checkpoint(args.checkpoint)
+    for name in args.tables:
+        copy_table(source, database.db.entities[name], checkpoint, args.batch_size)
+
+
+def legacy(args: argparse.Namespace):
+    source = Database('sqlite', os.path.abspath(args.source))
+    check_provider(database.db)
+    checkpoint = Checkpoint(args.checkpoint)
+    table = 'legacy_user'
+    if checkpoint.done(table):
+        print('legacy users already migrated')
+        return
+
+    after = checkpoint.last_key(table)
+    progress = Progress(table, checkpoint.rows(table))
+
+    while True:
+        with db_session:
+            batch = read_batch(source, 'User', ['userid', 'phone_number', 'sms_code', 'refr_token', 'auth_token'],
+                               'userid', after, args.batch_size)
+            if batch:
+                insert_entities(database.User, [{'userid': userid, 'geocheck': True, 'airquality': True}
+                                                for userid, *_ in batch])
+                # the only phone number of legacy user becomes the default one
+                insert_entities(database.PhoneNumberConfig, [
+                    {'user': userid, 'default_to': userid, 'prefix': args.prefix, 'phone_number': phone_number,
+                     'sms_code': sms_code, 'refr_token': refr_token, 'auth_token': auth_token, 'notifications': True}
+                    for userid, phone_number, sms_code, refr_token, auth_token in batch])
+                commit()
+
+        if not batch:
+            checkpoint.save(table, rows=progress.rows, done=True)
+            progress.finish()
+            return
+
+        after = batch[-1][0]
+        progress.update(len(batch))
+        checkpoint.save(table, last_key=after, rows=progress.rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Moves data into database of config.yml in resumable batches')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows read and inserted in one transaction')
+    parser.add_argument('--checkpoint', default='migration.json', help='file progress is saved to and resumed from')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    copy_parser = commands.add_parser('copy', help='copy data from database described in another config file')
+    copy_parser.add_argument('source', help='config file with database_settings of source database')
+    copy_parser.add_argument('--tables', default=','.join(TABLES), help=f'comma separated subset of {", ".join(TABLES)}')
+    copy_parser.set_defaults(run=copy)
+
+    legacy_parser = commands.add_parser('legacy', help='migrate SQLite database of old bot versions')
+    legacy_parser.add_argument('source', help='path to old SQLite database')
+    legacy_parser.add_argument('--prefix', default='+48', help='prefix of phone numbers, old versions did not store it')
+    legacy_parser.set_defaults(run=legacy)
+
+    args = parser.parse_args()
+    if args.command == 'copy':
+        args.tables = [table for table in args.tables.split(',') if table]
+        if unknown := set(args.tables) - set(TABLES):
+            parser.error(f'unknown tables: {", ".join(sorted(unknown))}')
+
+        args.tables = [table for table in TABLES if table in args.tables]  # keep referenced tables first
+
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import asyncio
+import heapq
+import logging
+import random
+import time
+from typing import Dict, List, Set, Tuple
+
+from inpost.static import ParcelStatus, ParcelType, UnauthorizedError, NotAuthenticatedError
+from telethon import TelegramClient
+
+import async_database
+from clients import InpostRegistry
+from constants import fast_poll_statuses, notification_message_builder
+from outbox import NOTIFICATION, outbox
+from sharding import LeaseManager
+from utils import get_parcels_with_raw
+
+
+class ParcelNotifier:
+    """Polls opted-in accounts in background and pushes a message whenever tracked parcel changes its status"""
+
+    def __init__(self, client: TelegramClient, registry: InpostRegistry, fast_interval: int = 300,
+                 slow_interval: int = 3600, jitter: float = 0.1, max_concurrency: int = 10,
+                 refresh_interval: int = 600, lease_manager: LeaseManager | None = None):
+        self.client = client
+        self.registry = registry
+        self.lease_manager = lease_manager
+        self.lag = 0.0
+        self.fast_interval = fast_interval
+        self.slow_interval = slow_interval
+        self.jitter = jitter
+        self.refresh_interval = refresh_interval
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._accounts: Dict[Tuple[int, int], bool | None] = {}  # (userid, phone_number) -> data collecting consent
+        self._schedule: List[Tuple[float, Tuple[int, int]]] = []
+        self._scheduled: Set[Tuple[int, int]] = set()
+        self._statuses: Dict[Tuple[int, int], Dict[str, str]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._lease_generation = -1
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def _with_jitter(self, interval: float) -> float:
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def _push(self, key: Tuple[int, int], delay: float):
+        heapq.heappush(self._schedule, (time.monotonic() + delay, key))
+        self._scheduled.add(key)
+
+    async def refresh_accounts(self):
+        accounts = await async_database.get_notification_accounts()
+        self._accounts = {(userid, phone_number): consent for userid, phone_number, consent in accounts
+                          if self.lease_manager is None or self.lease_manager.owns(phone_number)}
+
+        for key in self._accounts:
+            if key not in self._scheduled:
+                # spread first polls over fast interval, so startup does not hit inpost all at once
+                self._push(key, random.uniform(0, self.fast_interval))
+
+        for key in set(self._statuses) - set(self._accounts):
+            del self._statuses[key]
+
+    async def run(self):
+        next_refresh = 0.0
+        while True:
+            if self.lease_manager is not None and self.lease_manager.generation != self._lease_generation:
+                self._lease_generation = self.lease_manager.generation
+                next_refresh = 0.0
+
+            if time.monotonic() >= next_refresh:
+                try:
+                    await self.refresh_accounts()
+                except Exception as e:
+                    self._log.exception(e)
+
+                next_refresh = time.monotonic() + self.refresh_interval
+
+            while self._schedule and self._schedule[0][0] <= time.monotonic():
+                due, key = heapq.heappop(self._schedule)
+                self._scheduled.discard(key)
+                if key not in self._accounts:  # account opted out, was removed or its shard moved to other worker
+                    continue
+
+                task = asyncio.create_task(self.poll(key, due))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            wake_up = min(self._schedule[0][0] if self._schedule else next_refresh, next_refresh)
+            await asyncio.sleep(max(min(wake_up - time.monotonic(), 1.0), 0.05))
+
+    def stats(self) -> Tuple[int, float]:
+        return len(self._accounts), self.lag
+
+    async def poll(self, key: Tuple[int, int], due: float):
+        userid, phone_number = key
+        interval = self.slow_interval
+        try:
+            async with self._semaphore:
+                # how late, because of concurrency cap or slow loop, polls start compared to their schedule
+                self.lag = time.monotonic() - due
+                if self.lease_manager is not None and not self.lease_manager.owns(phone_number):
+                    return
+
+                inp = await self.registry.get(userid=userid, phone_number=phone_number)
+                packages = await get_parcels_with_raw(inp=inp, status=None, parcel_type=ParcelType.TRACKED)
+
+            if any(package.status in fast_poll_statuses for package, _ in packages):
+                interval = self.fast_interval
+
+            await self.notify(key, packages)
+
+        except (UnauthorizedError, NotAuthenticatedError) as e:
+            self._log.warning(f'could not poll {phone_number}, not authorized: {e.reason}')
+        except Exception as e:
+            self._log.exception(e)
+        finally:
+            if key in self._accounts and key not in self._scheduled:
+                self._push(key, self._with_jitter(interval))
+
+    async def notify(self, key: Tuple[int, int], packages):
+        userid, phone_number = key
+        seeded = key in self._statuses
+        if not seeded:
+            self._statuses[key] = await async_database.get_latest_parcel_statuses(
+                phone_number=phone_number, shipment_numbers=[package.shipment_number for package, _ in packages])
+
+        known = self._statuses[key]
+        changed = []
+        for package, raw in packages:
+            previous = known.get(package.shipment_number)
+            known[package.shipment_number] = package.status.name
+
+            if previous == package.status.name:
+                continue
+
+            changed.append(raw)
+            # parcels never seen before are announced only after the first pass, otherwise startup would flood
+            if previous is None and (not seeded or package.status == ParcelStatus.DELIVERED):
+                continue
+
+            message = notification_message_builder(
+                package=package, previous_status=ParcelStatus[previous] if previous is not None else None)
+            await outbox.send(chat_id=userid, request=lambda: self.client.send_message(userid, message),
+                              priority=NOTIFICATION)
+
+        if changed and self._accounts.get(key):
+            await async_database.add_parcels(userid=userid, phone_number=phone_number, parcels=changed,
+                                             ptype=ParcelType.TRACKED)
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+from telethon.errors import FloodWaitError
+
+from database import config
+from tracing import span
+
+INTERACTIVE = 0  # replies to user actions, always sent before anything else
+NOTIFICATION = 10  # background pushes, e.g. parcel status changes
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token is available"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class Outbox:
+    """Single outbound queue for messages sent to telegram, rate limited per chat and globally, with priorities
+    and flood wait back-off"""
+
+    def __init__(self, global_rate: float = 30, global_burst: int = 30, chat_rate: float = 1, chat_burst: int = 3,
+                 max_flood_retries: int = 3):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_flood_retries = max_flood_retries
+        self._global = TokenBucket(rate=global_rate, burst=global_burst)
+        self._chats: Dict[int, TokenBucket] = {}
+        self._blocked: Dict[int, float] = {}  # chat -> monotonic time until which telegram asked us to wait
+        self._busy: Set[int] = set()  # chats with request in flight, so messages to single chat keep their order
+        self._queue: List[Tuple[int, int, int, Callable[[], Awaitable], asyncio.Future, float, int]] = []
+        self._seq = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._worker: asyncio.Task | None = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._stats = {'sent': 0, 'failed': 0, 'flood_waits': 0, 'wait': 0.0, 'max_wait': 0.0, 'time': 0.0,
+                       'max_time': 0.0}
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    async def send(self, chat_id: int, request: Callable[[], Awaitable], priority: int = INTERACTIVE):
+        """Queues request (a callable returning awaitable which sends something to chat_id) and returns its result"""
+        if self._worker is None or self._worker.done():  # worker has to be started inside running event loop
+            self._wakeup = asyncio.Event()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        self._push(priority, next(self._seq), chat_id, request, future, time.monotonic(), 0)
+        with span('send'):
+            return await future
+
+    async def reply(self, event, *args, priority: int = INTERACTIVE, **kwargs):
+        return await self.send(chat_id=event.chat_id, request=lambda: event.reply(*args, **kwargs),
+                               priority=priority)
+
+    async def edit(self, event, *args, priority: int = INTERACTIVE, **kwargs):
+        return await self.send(chat_id=event.chat_id, request=lambda: event.edit(*args, **kwargs),
+                               priority=priority)
+
+    async def send_message(self, convo, *args, priority: int = INTERACTIVE, **kwargs):
+        return await self.send(chat_id=convo.chat_id, request=lambda: convo.send_message(*args, **kwargs),
+                               priority=priority)
+
+    def _push(self, *item):
+        heapq.heappush(self._queue, item)
+        self._wakeup.set()
+
+    def _next_ready(self, now: float) -> Tuple[tuple | None, float]:
+        """Pops most important request which chat may be sent to now, otherwise returns time to wait"""
+        skipped = []
+        ready = None
+        wait = 1.0
+        while self._queue:
+            item = heapq.heappop(self._queue)
+            chat_id = item[2]
+            if item[4].done():  # caller was cancelled meanwhile, nothing to send
+                continue
+
+            if chat_id in self._busy:
+                skipped.append(item)
+                continue
+
+            chat_wait = max(self._blocked.get(chat_id, 0.0) - now,
+                            self._chats[chat_id].delay(now) if chat_id in self._chats else 0.0)
+            if chat_wait > 0:
+                wait = min(wait, chat_wait)
+                skipped.append(item)
+                continue
+
+            ready = item
+            break
+
+        for item in skipped:
+            heapq.heappush(self._queue, item)
+
+        return ready, wait
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while self._queue:
+                now = time.monotonic()
+                if (wait := self._global.delay(now)) > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                item, wait = self._next_ready(now)
+                if item is None:
+                    # nothing can be sent now, sleep until some chat is ready or new request comes
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+
+                    self._wakeup.clear()
+                    continue
+
+                chat_id = item[2]
+                self._global.take(now)
+                self._chats.setdefault(chat_id, TokenBucket(rate=self.chat_rate, burst=self.chat_burst)).take(now)
+                self._busy.add(chat_id)
+
+                task = asyncio.create_task(self._dispatch(item))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            self._prune(time.monotonic())
+
+    async def _dispatch(self, item):
+        priority, seq, chat_id, request, future, queued_at, retries = item
+        started = time.monotonic()
+        try:
+            result = await request()
+        except FloodWaitError as e:
+            self._stats['flood_waits'] += 1
+            self._blocked[chat_id] = time.monotonic() + e.seconds
+            self._log.warning(f'flood wait for {e.seconds}s in chat {chat_id}')
+            if retries < self.max_flood_retries and not future.done():
+                # same sequence number keeps message in front of others sent to this chat later
+                self._push(priority, seq, chat_id, request, future, queued_at, retries + 1)
+            elif not future.done():
+                self._stats['failed'] += 1
+                future.set_exception(e)
+        except Exception as e:
+            self._stats['failed'] += 1
+            if not future.done():
+                future.set_exception(e)
+        else:
+            self._record(wait=started - queued_at, duration=time.monotonic() - started)
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._busy.discard(chat_id)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def _record(self, wait: float, duration: float):
+        self._stats['sent'] += 1
+        self._stats['wait'] += wait
+        self._stats['max_wait'] = max(self._stats['max_wait'], wait)
+        self._stats['time'] += duration
+        self._stats['max_time'] = max(self._stats['max_time'], duration)
+
+    def _prune(self, now: float):
+        # idle chats have full buckets and would behave the same way when recreated
+        for chat_id in [chat_id for chat_id, bucket in self._chats.items() if bucket.full(now)]:
+            del self._chats[chat_id]
+
+        for chat_id in [chat_id for chat_id, until in self._blocked.items() if until <= now]:
+            del self._blocked[chat_id]
+
+    def stats(self) -> dict:
+        sent = self._stats['sent']
+        return {
+            **self._stats,
+            'queue_depth': self.queue_depth,
+            'queue_depth_by_priority': {priority: sum(1 for item in self._queue if item[0] == priority)
+                                        for priority in {item[0] for item in self._queue}},
+            'in_flight': len(self._busy),
+            'blocked_chats': len(self._blocked),
+            'avg_wait': self._stats['wait'] / sent if sent else 0.0,
+            'avg_time': self._stats['time'] / sent if sent else 0.0,
+        }
+
+    async def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+
+        for task in self._tasks:
+            task.cancel()
+
+        while self._queue:
+            if not (future := heapq.heappop(self._queue)[4]).done():
+                future.cancel()
+
+
+outbox = Outbox(**config.get('outbox', {}))
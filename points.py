@@ -0,0 +1,184 @@
+import json
+import logging
+import math
+import os
+from typing import Dict, Iterable, List, Tuple
+
+from database import config
+
+EARTH_RADIUS = 6371008.8  # meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+
+
+def haversine(lat1: float, long1: float, lat2: float, long2: float) -> float:
+    """Great-circle distance in meters"""
+    lat1, long1, lat2, long2 = map(math.radians, (lat1, long1, lat2, long2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class PickupPoint:
+    def __init__(self, name: str, latitude: float, longitude: float, city: str | None = None,
+                 street: str | None = None, building_number: str | None = None, post_code: str | None = None,
+                 description: str | None = None):
+        self.name = name
+        self.latitude = latitude
+        self.longitude = longitude
+        self.city = city
+        self.street = street
+        self.building_number = building_number
+        self.post_code = post_code
+        self.description = description
+
+    @classmethod
+    def from_raw(cls, raw: dict) -> 'PickupPoint':
+        """Reads point in format of parcel's pickUpPoint or of ShipX points API"""
+        address = raw.get('addressDetails') or raw.get('address_details') or {}
+        return cls(name=raw['name'], latitude=float(raw['location']['latitude']),
+                   longitude=float(raw['location']['longitude']), city=address.get('city'),
+                   street=address.get('street'), post_code=address.get('postCode') or address.get('post_code'),
+                   building_number=address.get('buildingNumber') or address.get('building_number'),
+                   description=raw.get('locationDescription') or raw.get('location_description'))
+
+    def to_raw(self) -> dict:
+        """Point in format of parcel's pickUpPoint, so saved catalogue is imported back with from_raw"""
+        return {'name': self.name, 'location': {'latitude': self.latitude, 'longitude': self.longitude},
+                'addressDetails': {'city': self.city, 'street': self.street, 'buildingNumber': self.building_number,
+                                   'postCode': self.post_code},
+                'locationDescription': self.description}
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class PickupPointCatalogue:
+    """Pickup points seen in parcels or imported from file, bucketed in grid of cell_size degrees, so nearby points
+    are found by looking into a few cells only"""
+
+    def __init__(self, cell_size: float = 0.01, range_meters: float = 50, nearest_max_distance: float = 1000,
+                 import_file: str | None = None, path: str | None = 'pickup_points.json', scan_database: bool = True,
+                 scan_batch_size: int = 1000):
+        self.cell_size = cell_size
+        self.range_meters = range_meters
+        self.nearest_max_distance = nearest_max_distance
+        self.import_file = import_file
+        self.path = path
+        self.scan_database = scan_database
+        self.scan_batch_size = scan_batch_size
+        self._points: Dict[str, PickupPoint] = {}
+        self._cells: Dict[Tuple[int, int], List[PickupPoint]] = {}
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def _cell(self, latitude: float, longitude: float) -> Tuple[int, int]:
+        return math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size)
+
+    def get(self, name: str) -> PickupPoint | None:
+        return self._points.get(name)
+
+    def add(self, point: PickupPoint):
+        if (known := self._points.get(point.name)) is not None:
+            if (known.latitude, known.longitude) == (point.latitude, point.longitude):
+                self._points[point.name] = point  # same place, maybe fresher description
+                cell = self._cells[self._cell(point.latitude, point.longitude)]
+                cell[cell.index(known)] = point
+                return
+
+            self._cells[self._cell(known.latitude, known.longitude)].remove(known)  # point was moved
+
+        self._points[point.name] = point
+        self._cells.setdefault(self._cell(point.latitude, point.longitude), []).append(point)
+
+    def add_raw(self, raw: dict | None):
+        if not raw or raw.get('location') is None:  # parcels sent to address have no pickup point
+            return
+
+        try:
+            point = PickupPoint.from_raw(raw)
+        except (KeyError, TypeError, ValueError) as e:
+            self._log.warning(f'skipping malformed pickup point {raw.get("name")}: {e}')
+            return
+
+        known = self._points.get(point.name)
+        if known is None or (known.latitude, known.longitude) != (point.latitude, point.longitude):
+            self.add(point)
+
+    def add_many(self, raws: Iterable[dict]) -> int:
+        before = len(self._points)
+        for raw in raws:
+            self.add_raw(raw)
+
+        return len(self._points) - before
+
+    def import_points(self, path: str) -> int:
+        """Imports JSON list of points, ShipX like {"items": [...]} page or JSON lines file, returns new points"""
+        with open(path) as f:
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError:
+                f.seek(0)
+                data = [json.loads(line) for line in f if line.strip()]
+
+        return self.add_many(data['items'] if isinstance(data, dict) else data)
+
+    def restore(self) -> bool:
+        """Imports catalogue saved by previous run, returns False when there is none"""
+        if not self.path or not os.path.exists(self.path):
+            return False
+
+        self.import_points(self.path)
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump([point.to_raw() for point in self._points.values()], f)
+
+        os.replace(self.path + '.tmp', self.path)  # catalogue is never left half written
+
+    def within(self, latitude: float, longitude: float, radius: float) -> List[Tuple[float, PickupPoint]]:
+        """Points at most radius meters away, nearest first"""
+        lat_cells = math.ceil(radius / METERS_PER_DEGREE / self.cell_size)
+        # degree of longitude shrinks towards poles, so more cells are needed to cover the same distance
+        long_cells = math.ceil(radius / (METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+                               / self.cell_size)
+        lat_cell, long_cell = self._cell(latitude, longitude)
+
+        found = []
+        for i in range(lat_cell - lat_cells, lat_cell + lat_cells + 1):
+            for j in range(long_cell - long_cells, long_cell + long_cells + 1):
+                for point in self._cells.get((i, j), ()):
+                    if (distance := haversine(latitude, longitude, point.latitude, point.longitude)) <= radius:
+                        found.append((distance, point))
+
+        return sorted(found, key=lambda found_point: found_point[0])
+
+    def nearest(self, latitude: float, longitude: float,
+                max_distance: float | None = None) -> Tuple[float, PickupPoint] | None:
+        """Nearest point not further than max_distance meters, searches growing radius, so dense areas stay cheap"""
+        max_distance = max_distance if max_distance is not None else self.nearest_max_distance
+        radius = min(self.cell_size * METERS_PER_DEGREE / 2, max_distance)
+        while True:
+            if found := self.within(latitude, longitude, radius):
+                return found[0]
+
+            if radius >= max_distance:
+                return None
+
+            radius = min(radius * 2, max_distance)
+
+    def in_range(self, point, latitude: float, longitude: float) -> bool:
+        return haversine(latitude, longitude, point.latitude, point.longitude) <= self.range_meters
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'points': len(self._points),
+            'cells': len(self._cells),
+        }
+
+
+pickup_points = PickupPointCatalogue(**config.get('pickup_points', {}))
@@ -0,0 +1,94 @@
+import hashlib
+import hmac
+import json
+import logging
+import time
+from functools import wraps
+
+from callbacks import PARCEL_CALLBACK_MAGIC, decode_parcel_callback
+from database import config
+
+DEFAULT_SALT = 'change-me'  # salt example config ships with
+
+
+class UpdateRecorder:
+    """Appends anonymized incoming updates to JSONL file, so real traffic can be replayed with replay.py.
+
+    Only handler, kind of update, command name, button meaning and time are stored; user ids are salted hashes,
+    phone and shipment numbers are never written."""
+
+    def __init__(self, enabled: bool = False, path: str = 'updates.jsonl', salt: str = '', flush_every: int = 100):
+        if enabled and salt in ('', DEFAULT_SALT):
+            # user ids are short enough to brute force their hashes when salt is known
+            raise ValueError('recording.salt has to be set to a random secret before recording is enabled')
+
+        self.enabled = enabled
+        self.path = path
+        self.salt = salt.encode()
+        self.flush_every = flush_every
+        self.recorded = 0
+        self._file = None
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def anonymize(self, userid: int) -> str:
+        return hmac.new(self.salt, str(userid).encode(), hashlib.sha256).hexdigest()[:16]
+
+    @staticmethod
+    def describe(event) -> dict:
+        if (data := getattr(event, 'data', None)) is not None:
+            if data.startswith(PARCEL_CALLBACK_MAGIC):
+                action, parcel_type, _, _ = decode_parcel_callback(data)
+                return {'kind': 'callback', 'action': action.name, 'parcel_type': parcel_type.name}
+
+            data = data.decode('utf-8', errors='replace')
+            if data.startswith('List:'):
+                _, list_filter, _, page = data.split(':')
+                return {'kind': 'callback', 'list': list_filter, 'page': int(page)}
+
+            # remaining buttons are fixed labels, except phone number choices
+            return {'kind': 'callback', 'data': None if any(c.isdigit() for c in data) else data}
+
+        text = getattr(event, 'raw_text', None) or ''
+        if text.startswith('/'):
+            return {'kind': 'message', 'command': text.split()[0]}
+
+        message = getattr(event, 'message', None)
+        if getattr(message, 'contact', None) is not None:
+            return {'kind': 'message', 'content': 'contact'}
+
+        return {'kind': 'message', 'content': 'geo' if getattr(message, 'geo', None) is not None else 'text'}
+
+    def record(self, handler: str, event):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+
+        entry = {'at': round(time.time(), 3), 'handler': handler, 'user': self.anonymize(event.sender_id),
+                 **self.describe(event)}
+        self._file.write(json.dumps(entry) + '\n')
+        self.recorded += 1
+        if self.recorded % self.flush_every == 0:
+            self._file.flush()
+
+    def handler(self, func):
+        """Records every update passed to telegram handler, leaves handler untouched when recording is off"""
+        if not self.enabled:
+            return func
+
+        @wraps(func)
+        async def wrapper(event, *args, **kwargs):
+            try:
+                self.record(func.__name__, event)
+            except Exception as e:  # recording must never break handling
+                self._log.exception(e)
+
+            return await func(event, *args, **kwargs)
+
+        return wrapper
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+recorder = UpdateRecorder(**config.get('recording', {}))
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Callable, Dict, Hashable, Tuple
+
+from arrow import Arrow
+from inpost.static import Parcel
+
+from database import config
+
+# strftime equivalent of arrow's `DD.MM.YYYY HH:mm`, arrow tokenizes its pattern on every call
+date_format = '%d.%m.%Y %H:%M'
+
+
+@lru_cache(maxsize=65536)
+def _local_datetime(timestamp: float) -> str:
+    # naive fromtimestamp converts to local timezone of the host, which is what arrow's .to('local') does
+    return datetime.fromtimestamp(timestamp).strftime(date_format)
+
+
+def local_datetime(date: Arrow | None) -> str:
+    """Formats date in local time, same timestamps come back with every listing, so results are cached"""
+    return _local_datetime(date.timestamp()) if date is not None else '-'
+
+
+def parcel_version(parcel: Parcel) -> Tuple[str, str, float]:
+    """Identifies state of parcel, anything rendered from it stays valid as long as this does not change"""
+    return (str(parcel.shipment_number), parcel.status.name,
+            max((event.date.timestamp() for event in parcel.event_log or ()), default=0.0))
+
+
+class FragmentCache:
+    """Bounded, LRU evicted cache of rendered message fragments"""
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._fragments: OrderedDict[Hashable, str] = OrderedDict()
+
+    def render(self, key: Hashable, build: Callable[[], str]) -> str:
+        if (fragment := self._fragments.get(key)) is not None:
+            self._fragments.move_to_end(key)
+            self.hits += 1
+            return fragment
+
+        self.misses += 1
+        fragment = self._fragments[key] = build()
+        while len(self._fragments) > self.max_size:
+            self._fragments.popitem(last=False)
+
+        return fragment
+
+    def clear(self):
+        self._fragments.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._fragments),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+fragment_cache = FragmentCache(**config.get('fragment_cache', {}))
@@ -0,0 +1,102 @@
+"""Micro-benchmark of message rendering.
+
+Renders parcel list entries and event logs of fake parcels with arrow based builders the bot used before
+rendering.py and with current ones, both without fragment cache (only cached date formatting) and with it:
+
+    python rendering_benchmark.py --parcels 50 --repeat 200
+"""
+import argparse
+import logging
+import timeit
+from typing import Callable, Dict, List
+
+from inpost.static import Parcel, ParcelStatus
+
+from benchmark import BASE_PHONE_NUMBER, add_environment_arguments, fake_parcels, run_in_workdir
+
+
+def legacy_entry_builder(index: int, package: Parcel, group_size: int | None) -> str:
+    entry = f'**{index}.** 📦 `{package.shipment_number}`\n' \
+            f'📤 `{package.sender.sender_name if package.sender is not None else None}`\n' \
+            f'📮 `{package.status.value}`'
+
+    if group_size is not None:
+        entry = entry + f'\n⚠️ **Multicompartment containing {group_size} parcels**'
+
+    if package.status in (ParcelStatus.STACK_IN_BOX_MACHINE, ParcelStatus.STACK_IN_CUSTOMER_SERVICE_POINT):
+        entry = entry + '\n⚠️ **Substitutionary pick up point!**'
+
+    if package.status in (ParcelStatus.READY_TO_PICKUP, ParcelStatus.STACK_IN_BOX_MACHINE,
+                          ParcelStatus.STACK_IN_CUSTOMER_SERVICE_POINT, ParcelStatus.PICKUP_REMINDER_SENT):
+        entry = entry + f'\n🫳 **Pick up until:** `{package.expiry_date.to("local").format("DD.MM.YYYY HH:mm")}`'
+
+    return entry
+
+
+def legacy_events_builder(parcel: Parcel) -> str:
+    return "\n".join(f'{status.date.to("local").format("DD.MM.YYYY HH:mm"):>22}: {status.name.value}' for status in
+                     parcel.event_log)
+
+
+async def run(args: argparse.Namespace):
+    # constants and rendering read config.yml of current directory when imported
+    from constants import events_builder, parcel_list_entry_builder, parcel_summary_builder
+    from rendering import _local_datetime, fragment_cache
+    from utils import parcel_events, parcel_summary
+
+    parcels = [Parcel(raw, logging.getLogger('Inpost')) for raw in fake_parcels(BASE_PHONE_NUMBER, args.parcels)]
+
+    def check(legacy: Callable[[Parcel], str], current: Callable[[Parcel], str]):
+        for parcel in parcels:
+            if legacy(parcel) != current(parcel):
+                raise AssertionError(f'{current.__name__} renders {parcel.shipment_number} differently')
+
+    def cold(render: Callable[[], None]) -> Callable[[], None]:
+        def wrapper():
+            _local_datetime.cache_clear()
+            fragment_cache.clear()
+            render()
+
+        return wrapper
+
+    lists: Dict[str, Callable[[], List[str]]] = {
+        'legacy': lambda: [legacy_entry_builder(index, parcel, None) for index, parcel in enumerate(parcels)],
+        'uncached': lambda: [parcel_list_entry_builder(index, parcel_summary_builder(parcel, None))
+                             for index, parcel in enumerate(parcels)],
+        'cached': lambda: [parcel_list_entry_builder(index, parcel_summary(parcel, None))
+                           for index, parcel in enumerate(parcels)],
+    }
+    events: Dict[str, Callable[[], List[str]]] = {
+        'legacy': lambda: [legacy_events_builder(parcel) for parcel in parcels],
+        'uncached': lambda: [events_builder(parcel) for parcel in parcels],
+        'cached': lambda: [parcel_events(parcel) for parcel in parcels],
+    }
+
+    check(lambda parcel: legacy_entry_builder(1, parcel, None),
+          lambda parcel: parcel_list_entry_builder(1, parcel_summary_builder(parcel, None)))
+    check(legacy_events_builder, events_builder)
+
+    print(f'{"fragment":<10}{"builder":<10}{"cold us":>10}{"warm us":>10}{"speedup":>9}')
+    for fragment, builders in (('list', lists), ('events', events)):
+        baseline = None
+        for builder, render in builders.items():
+            cold_time = min(timeit.repeat(cold(render), number=1, repeat=args.repeat)) / len(parcels)
+            warm_time = min(timeit.repeat(render, number=1, repeat=args.repeat)) / len(parcels)
+            baseline = baseline or warm_time
+            print(f'{fragment:<10}{builder:<10}{cold_time * 1e6:>10.1f}{warm_time * 1e6:>10.1f}'
+                  f'{baseline / warm_time:>8.1f}x')
+
+    print(f'\nfragment cache: {fragment_cache.stats()}, dates: {_local_datetime.cache_info()}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark of parcel list and event log rendering')
+    parser.add_argument('--repeat', type=int, default=100, help='renders of all parcels, best one is reported')
+    add_environment_arguments(parser)
+    args = parser.parse_args()
+
+    run_in_workdir(args, run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Replays updates recorded by recorder.UpdateRecorder against bot handlers, local fake Inpost API and SQLite.
+
+Recorded users are mapped to synthetic accounts and their parcel buttons to parcels of fake API. While replaying,
+event loop lag, database executor queue and outbox queue are sampled, so it is visible which of them saturates first:
+
+    python replay.py updates.jsonl --speed 10
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+from benchmark import ErrorCounter, FakeEvent, FakeInpostApi, FakeTelegram, add_environment_arguments, \
+    benchmark_config, parcel_event, percentile, point_inpost_at, run_in_workdir, seed_users, synthetic_users
+from callbacks import ParcelAction
+
+SKIPPED_HANDLERS = {'init_user'}  # logging in needs real sms code
+
+
+def load_recording(path: str) -> List[dict]:
+    with open(path) as f:
+        return sorted((json.loads(line) for line in f if line.strip()), key=lambda record: record['at'])
+
+
+class SaturationMonitor:
+    """Samples event loop lag, database executor and outbox queues in fixed intervals"""
+
+    def __init__(self, executor, outbox, interval: float = 0.05):
+        self.executor = executor
+        self.outbox = outbox
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.samples: List[Tuple[float, float, int, int, int]] = []  # offset, loop lag, db queue, db busy, outbox
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append((time.perf_counter() - self.started, max(loop.time() - expected, 0.0),
+                                 self.executor.queue_depth, self.executor.in_flight, self.outbox.queue_depth))
+
+    def window(self, since: float) -> List[Tuple[float, float, int, int, int]]:
+        return [sample for sample in self.samples if sample[0] >= since]
+
+    def first(self, saturated) -> float | None:
+        return next((sample[0] for sample in self.samples if saturated(sample)), None)
+
+
+async def replay(args: argparse.Namespace):
+    # these modules read config.yml of current directory when imported, so they are imported once it is in place
+    import async_database
+    from clients import InpostRegistry
+    from main import register_handlers
+    from outbox import outbox
+
+    records = load_recording(args.recording)
+    if not records:
+        print('Recording is empty')
+        return
+
+    anonymized_users = list(dict.fromkeys(record['user'] for record in records))
+    users: Dict[str, Tuple[int, int]] = dict(zip(anonymized_users, synthetic_users(len(anonymized_users))))
+    parcel_requests: Dict[str, int] = defaultdict(int)  # rotates parcel buttons of every user
+
+    api = FakeInpostApi(parcel_count=args.parcels, latency=args.inpost_latency)
+    point_inpost_at(await api.start())
+    telegram = FakeTelegram(latency=args.telegram_latency)
+    registry = InpostRegistry()
+    register_handlers(client=telegram, inpost_registry=registry, config=benchmark_config(os.getcwd(), args))
+    await seed_users(telegram, list(users.values()))
+
+    def replayable(record: dict) -> bool:
+        return record['handler'] not in SKIPPED_HANDLERS and record['handler'] in telegram.handlers
+
+    def update(record: dict) -> FakeEvent:
+        userid, phone_number = users[record['user']]
+        if record['kind'] == 'message':
+            return FakeEvent(telegram, userid, text=record.get('command', ''))
+
+        if 'action' in record:  # fake API serves tracked parcels only, so recorded parcel type is not used
+            parcel_requests[record['user']] += 1
+            return parcel_event(telegram, api, ParcelAction[record['action']], userid, phone_number,
+                                parcel_requests[record['user']])
+
+        if 'list' in record:
+            return FakeEvent(telegram, userid, data=f'List:{record["list"]}:{phone_number}:{record["page"]}'.encode())
+
+        # button without recorded label was a phone number choice
+        return FakeEvent(telegram, userid, data=(record['data'] or str(phone_number)).encode())
+
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+    monitor = SaturationMonitor(executor=async_database.executor, outbox=outbox, interval=args.sample_interval)
+    latencies: List[float] = []
+    in_flight = set()
+    skipped = 0
+
+    async def handle(handler: str, record: dict):
+        event = update(record)  # built inside handling task, so conversation answers scripted for it stay there
+        started = time.perf_counter()
+        await telegram.handlers[handler](event)
+        latencies.append(time.perf_counter() - started)
+
+    async def report():
+        print(f'{"time s":>7}{"done":>8}{"in flight":>10}{"loop lag ms":>12}{"db queue":>9}{"outbox":>8}')
+        while True:
+            since = time.perf_counter() - monitor.started
+            await asyncio.sleep(args.report_interval)
+            window = monitor.window(since) or [(0, 0.0, 0, 0, 0)]
+            print(f'{since + args.report_interval:>7.1f}{len(latencies):>8}{len(in_flight):>10}'
+                  f'{max(s[1] for s in window) * 1000:>12.1f}{max(s[2] for s in window):>9}'
+                  f'{max(s[4] for s in window):>8}')
+
+    tasks = [asyncio.create_task(monitor.run()), asyncio.create_task(report())]
+    try:
+        first = records[0]['at']
+        for record in records:
+            if args.speed:
+                if (delay := (record['at'] - first) / args.speed - (time.perf_counter() - monitor.started)) > 0:
+                    await asyncio.sleep(delay)
+            else:
+                await asyncio.sleep(0)  # let loop breathe, otherwise nothing is handled until all are dispatched
+
+            if not replayable(record):
+                skipped += 1
+                continue
+
+            task = asyncio.create_task(handle(record['handler'], record))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+        while in_flight:
+            await asyncio.gather(*in_flight)
+
+        elapsed = time.perf_counter() - monitor.started
+    finally:
+        for task in tasks:
+            task.cancel()
+
+        await outbox.close()
+        await registry.close()
+        await api.close()
+        async_database.executor.shutdown()
+
+    lags = [sample[1] for sample in monitor.samples]
+    database = async_database.executor.stats()['functions'].values()
+    database_calls = sum(stats['calls'] for stats in database)
+    outbox_stats = outbox.stats()
+    saturation = {
+        'event loop': monitor.first(lambda sample: sample[1] > args.lag_threshold),
+        # calls wait in queue while every worker is busy
+        'database pool': monitor.first(lambda sample: sample[2] > 0 and
+                                       sample[3] >= async_database.executor.max_workers),
+        'outbox': monitor.first(lambda sample: sample[4] > args.outbox_threshold),
+    }
+
+    print(f'\nreplayed {len(latencies)} updates of {len(users)} users in {elapsed:.1f}s '
+          f'({len(latencies) / elapsed:.1f}/s at speed {args.speed or "max"}), skipped {skipped}, '
+          f'errors {errors.errors}')
+    print(f'handler latency p50 {percentile(latencies, 0.5) * 1000:.1f}ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:.1f}ms, max {max(latencies, default=0.0) * 1000:.1f}ms')
+    print(f'event loop lag p50 {percentile(lags, 0.5) * 1000:.1f}ms, p99 {percentile(lags, 0.99) * 1000:.1f}ms, '
+          f'max {max(lags, default=0.0) * 1000:.1f}ms')
+    print(f'database {database_calls} calls, max queue {max((s[2] for s in monitor.samples), default=0)}, '
+          f'avg wait {sum(stats["wait"] for stats in database) / (database_calls or 1) * 1000:.1f}ms')
+    print(f'outbox {outbox_stats["sent"]} sent, max queue {max((s[4] for s in monitor.samples), default=0)}, '
+          f'avg wait {outbox_stats["avg_wait"] * 1000:.1f}ms, max wait {outbox_stats["max_wait"] * 1000:.1f}ms')
+    for resource, at in saturation.items():
+        print(f'{resource}: ' + (f'saturated {at:.1f}s into replay' if at is not None else 'not saturated'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays recorded updates against bot handlers and fake Inpost API')
+    parser.add_argument('recording', help='JSONL file written by recorder')
+    parser.add_argument('--speed', default='1', help='replay speed multiplier, e.g. 1 or 10, or max')
+    parser.add_argument('--sample-interval', type=float, default=0.05, help='seconds between saturation samples')
+    parser.add_argument('--report-interval', type=float, default=1.0, help='seconds between progress lines')
+    parser.add_argument('--lag-threshold', type=float, default=0.1,
+                        help='event loop lag in seconds considered saturation')
+    parser.add_argument('--outbox-threshold', type=int, default=10,
+                        help='outbox queue depth considered saturation')
+    add_environment_arguments(parser)
+    args = parser.parse_args()
+    args.recording = os.path.abspath(args.recording)
+    args.speed = None if args.speed == 'max' else float(args.speed)
+
+    run_in_workdir(args, replay)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from typing import Callable, Set, Tuple
+
+import async_database
+import database
+
+
+class LeaseManager:
+    """Keeps this worker's share of account shards leased in database, so background polling can be spread
+    across many bot processes. Expired leases of dead workers are picked up by the others on their heartbeat."""
+
+    def __init__(self, worker_id: str | None = None, shard_count: int = 64, lease_ttl: int = 60,
+                 heartbeat_interval: int = 15):
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+        self.shard_count = shard_count
+        self.lease_ttl = lease_ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.owned: Set[int] = set()
+        self.generation = 0
+        self.stats: Callable[[], Tuple[int, float]] = lambda: (0, 0.0)
+        self._valid_until = 0.0
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def owns(self, phone_number: int | str) -> bool:
+        # when heartbeats keep failing our leases may already belong to someone else
+        return time.monotonic() < self._valid_until and int(phone_number) % self.shard_count in self.owned
+
+    async def heartbeat(self):
+        started = time.monotonic()
+        shards = set(await async_database.rebalance_shard_leases(worker_id=self.worker_id,
+                                                                 shard_count=self.shard_count,
+                                                                 lease_ttl=self.lease_ttl))
+        self._valid_until = started + self.lease_ttl
+        if shards != self.owned:
+            self._log.info(f'worker {self.worker_id} now owns {len(shards)}/{self.shard_count} shards')
+            self.owned = shards
+            self.generation += 1
+
+        accounts, lag = self.stats()
+        await async_database.heartbeat_worker(worker_id=self.worker_id, accounts=accounts, lag=lag,
+                                              lease_ttl=self.lease_ttl)
+
+    async def run(self):
+        while True:
+            try:
+                await self.heartbeat()
+            except Exception as e:
+                self._log.exception(e)
+
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def close(self):
+        self.owned = set()
+        self.generation += 1
+        await async_database.release_shard_leases(worker_id=self.worker_id)
+
+
+def print_report(lease_ttl: int):
+    print(f'{"worker":<32}{"alive":>7}{"shards":>8}{"accounts":>10}{"lag [s]":>10}')
+    for worker in database.get_shard_report(lease_ttl=lease_ttl):
+        print(f'{worker["worker_id"]:<32}{str(worker["alive"]):>7}{worker["shards"]:>8}'
+              f'{worker["accounts"]:>10}{worker["lag"]:>10.1f}')
+
+
+def simulate_worker(worker_id: str, shard_count: int, lease_ttl: int, heartbeat_interval: int):
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    asyncio.run(LeaseManager(worker_id=worker_id, shard_count=shard_count, lease_ttl=lease_ttl,
+                             heartbeat_interval=heartbeat_interval).run())
+
+
+if __name__ == '__main__':
+    settings = database.config.get('sharding', {})
+    parser = argparse.ArgumentParser(description='Inspect or locally simulate background polling shards')
+    parser.add_argument('command', choices=['report', 'simulate'])
+    parser.add_argument('--workers', type=int, default=3, help='simulated worker processes')
+    parser.add_argument('--duration', type=int, default=60, help='simulation length in seconds, '
+                                                                 'first worker is killed halfway through')
+    args = parser.parse_args()
+
+    shard_count = settings.get('shard_count', 64)
+    lease_ttl = settings.get('lease_ttl', 60)
+    heartbeat_interval = settings.get('heartbeat_interval', 15)
+
+    if args.command == 'report':
+        print_report(lease_ttl=lease_ttl)
+    else:
+        workers = [multiprocessing.Process(target=simulate_worker,
+                                           args=(f'simulated-{i}', shard_count, lease_ttl, heartbeat_interval))
+                   for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
+
+        for second in range(args.duration):
+            time.sleep(1)
+            if second == args.duration // 2:
+                workers[0].kill()
+
+            if second % heartbeat_interval == 0:
+                print_report(lease_ttl=lease_ttl)
+
+        for worker in workers[1:]:
+            worker.kill()
+
+        print_report(lease_ttl=lease_ttl)
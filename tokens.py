@@ -0,0 +1,106 @@
+import asyncio
+import base64
+import json
+import logging
+import time
+from typing import Callable, Dict, Iterable, Tuple
+
+from inpost import Inpost
+from inpost.static import ReAuthenticationError, RefreshTokenError
+
+import async_database
+
+
+def token_expiry(token: str | None) -> float | None:
+    """Returns unix timestamp from `exp` claim of JWT auth token, None if it cannot be read"""
+    if not token:
+        return None
+
+    try:
+        payload = token.removeprefix('Bearer ').split('.')[1]
+        return float(json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenManager:
+    """Refreshes inpost auth tokens shortly before they expire, once per account no matter how many callers need it,
+    and stores refreshed tokens in database"""
+
+    def __init__(self, refresh_margin: int = 300, check_interval: int = 60):
+        self.refresh_margin = refresh_margin
+        self.check_interval = check_interval
+        self._known: Dict[Tuple[int, int], str] = {}  # last auth token stored in database per account
+        self._refreshing: Dict[Tuple[int, int], asyncio.Task] = {}
+        self._stats = {'refreshes': 0, 'coalesced': 0, 'failures': 0, 'persisted_external': 0}
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def _expires_soon(self, inp: Inpost) -> bool:
+        expiry = token_expiry(inp.auth_token)
+        return expiry is not None and expiry - time.time() < self.refresh_margin
+
+    async def ensure_fresh(self, key: Tuple[int, int], inp: Inpost):
+        """Makes sure token of inp is valid for at least refresh_margin seconds, called before client is handed out"""
+        if key not in self._known:
+            self._known[key] = inp.auth_token
+        elif self._known[key] != inp.auth_token and key not in self._refreshing:
+            # inpost library refreshed token on its own after 401, database still holds the old one
+            self._stats['persisted_external'] += 1
+            await self._persist(key, inp)
+
+        if self._expires_soon(inp):
+            try:
+                await self.refresh(key, inp)
+            except (ReAuthenticationError, RefreshTokenError):
+                pass  # already logged, request itself will surface UnauthorizedError to user
+            except Exception as e:  # token may still be valid for a while, so let request try anyway
+                self._log.exception(e)
+
+    def stored(self, key: Tuple[int, int], auth_token: str):
+        """Records token written to database outside of manager, e.g. after login, so it is not persisted again"""
+        self._known[key] = auth_token
+
+    async def refresh(self, key: Tuple[int, int], inp: Inpost):
+        if (task := self._refreshing.get(key)) is None:
+            task = asyncio.create_task(self._refresh(key, inp))
+            self._refreshing[key] = task
+            task.add_done_callback(lambda _: self._refreshing.pop(key, None))
+        else:
+            self._stats['coalesced'] += 1
+
+        # shielded, so caller being cancelled does not abort refresh others are waiting for
+        await asyncio.shield(task)
+
+    async def _refresh(self, key: Tuple[int, int], inp: Inpost):
+        try:
+            await inp.refresh_token()
+        except (ReAuthenticationError, RefreshTokenError) as e:
+            self._stats['failures'] += 1
+            self._log.warning(f'could not refresh token of {key[1]}: {e.reason}')
+            raise
+
+        self._stats['refreshes'] += 1
+        await self._persist(key, inp)
+
+    async def _persist(self, key: Tuple[int, int], inp: Inpost):
+        userid, phone_number = key
+        await async_database.edit_phone_number_config(event=None, userid=userid, phone_number=phone_number,
+                                                      auth_token=inp.auth_token, refr_token=inp.refr_token)
+        self._known[key] = inp.auth_token
+
+    async def run(self, clients: Callable[[], Iterable[Tuple[Tuple[int, int], Inpost]]]):
+        """Proactively refreshes tokens of clients returned by `clients`, so user requests never wait for it"""
+        while True:
+            for key, inp in list(clients()):
+                if not self._expires_soon(inp):
+                    continue
+
+                try:
+                    await self.refresh(key, inp)
+                except Exception as e:
+                    self._log.exception(e)
+
+            await asyncio.sleep(self.check_interval)
+
+    def stats(self) -> Dict[str, int]:
+        return {**self._stats, 'tracked': len(self._known), 'refreshing': len(self._refreshing)}
@@ -0,0 +1,137 @@
+import asyncio
+import cProfile
+import inspect
+import io
+import logging
+import os
+import pstats
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import List, Tuple
+
+from database import config
+
+
+class Trace:
+    """Timeline of spans recorded while single telegram update was handled"""
+
+    def __init__(self, name: str, userid: int | None):
+        self.name = name
+        self.userid = userid
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.spans: List[Tuple[float, float, int, str]] = []  # offset, duration, depth, name
+
+    def timeline(self) -> str:
+        lines = [f'{self.name} for {self.userid} took {self.duration * 1000:.1f}ms']
+        for offset, duration, depth, name in sorted(self.spans):
+            lines.append(f'{offset * 1000:9.1f}ms {duration * 1000:9.1f}ms {"  " * depth}{name}')
+
+        return '\n'.join(lines)
+
+
+_trace: ContextVar[Trace | None] = ContextVar('trace', default=None)
+# depth lives in its own variable, so concurrently gathered tasks nest their spans independently
+_depth: ContextVar[int] = ContextVar('depth', default=0)
+
+
+@contextmanager
+def span(name: str):
+    """Records duration of the block in trace of update being handled, does nothing outside of handlers"""
+    if (trace := _trace.get()) is None:
+        yield
+        return
+
+    depth = _depth.get()
+    token = _depth.set(depth + 1)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.spans.append((started - trace.started, time.perf_counter() - started, depth, name))
+        _depth.reset(token)
+
+
+def traced(func):
+    """Decorates helper function (coroutine or not), so its calls show up as spans"""
+    if inspect.iscoroutinefunction(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(func.__name__):
+                return await func(*args, **kwargs)
+    else:
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(func.__name__):
+                return func(*args, **kwargs)
+
+    return wrapper
+
+
+def trace_inpost(inp):
+    """Records every Inpost API request as span named after its `action`"""
+    request = inp.request
+
+    @wraps(request)
+    async def traced_request(*args, **kwargs):
+        with span(f'inpost {kwargs.get("action", "unknown")}'):
+            return await request(*args, **kwargs)
+
+    inp.request = traced_request
+    return inp
+
+
+class Tracer:
+    """Traces telegram updates, logs timelines of slow ones and profiles running bot on demand"""
+
+    def __init__(self, slow_update_threshold: float = 2.0, profile_dir: str = 'profiles', max_profile_seconds: int = 120):
+        self.slow_update_threshold = slow_update_threshold
+        self.profile_dir = profile_dir
+        self.max_profile_seconds = max_profile_seconds
+        self._profiling = False
+        self._log = logging.getLogger(self.__class__.__name__)
+
+    def handler(self, func):
+        """Starts new trace for every update passed to telegram handler"""
+        @wraps(func)
+        async def wrapper(event, *args, **kwargs):
+            trace = Trace(name=func.__name__, userid=getattr(event, 'sender_id', None))
+            token = _trace.set(trace)
+            try:
+                return await func(event, *args, **kwargs)
+            finally:
+                trace.duration = time.perf_counter() - trace.started
+                _trace.reset(token)
+                if trace.duration > self.slow_update_threshold:
+                    self._log.warning(f'slow update\n{trace.timeline()}')
+
+        return wrapper
+
+    async def profile(self, seconds: float) -> Tuple[str, str]:
+        """Profiles event loop thread for given time, writes cProfile stats file and returns its path with summary
+        of most expensive calls"""
+        if self._profiling:  # only one profiler may be attached to thread
+            raise RuntimeError('Profiler is already running')
+
+        seconds = min(seconds, self.max_profile_seconds)
+        self._profiling = True
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            self._profiling = False
+
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(self.profile_dir, f'profile-{time.strftime("%Y%m%d-%H%M%S")}.prof')
+        profiler.dump_stats(path)
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).strip_dirs().sort_stats('cumulative').print_stats(15)
+        return path, summary.getvalue()
+
+
+tracer = Tracer(**config.get('tracing', {}))
@@ -1,18 +1,31 @@
+import asyncio
 import datetime
+import logging
+from io import BytesIO
 from typing import List, Dict, Tuple
 
 import arrow
 from inpost import Inpost
-from inpost.static import Parcel, ParcelShipmentType, ParcelStatus, ParcelType, ParcelOwnership
+from inpost.static import Parcel, ParcelStatus, ParcelType, ParcelOwnership, SentParcel, \
+    ReturnParcel
 from telethon import Button
+from telethon.errors import FileReferenceExpiredError, MediaEmptyError, MessageNotModifiedError
 from telethon.events import NewMessage, CallbackQuery
 from telethon.tl.patched import Message
+from telethon.tl.types import InputPhoto
 
-import database
-from database import User
+import async_database
+from cache import parcel_cache, qr_code_cache, qr_code_hash
+from callbacks import ParcelAction, encode_parcel_callback
+from clients import inpost_calls
 from constants import multicompartment_message_builder, compartment_message_builder, delivered_message_builder, \
     details_message_builder, ready_to_pickup_message_builder, out_of_range_message_builder, open_comp_message_builder, \
-    pending_statuses
+    parcel_list_entry_builder, parcel_list_message_builder, parcel_list_filters, pending_statuses, \
+    parcel_summary_builder, events_builder
+from outbox import outbox
+from points import haversine, pickup_points
+from rendering import fragment_cache, local_datetime, parcel_version
+from tracing import traced
 
 
 async def init_phone_number(event: NewMessage) -> Tuple[int | str, str] | None:
@@ -48,8 +61,7 @@ async def confirm_location(event: NewMessage | Message,
         case ParcelStatus.DELIVERED:
             return 'DELIVERED'
         case ParcelStatus.READY_TO_PICKUP | ParcelStatus.STACK_IN_BOX_MACHINE | ParcelStatus.PICKUP_REMINDER_SENT | ParcelStatus.PICKUP_TIME_EXPIRED:
-            if (p.pickup_point.latitude - 0.0005 <= loc.lat <= p.pickup_point.latitude + 0.0005) and (
-                    p.pickup_point.longitude - 0.0005 <= loc.long <= p.pickup_point.longitude + 0.0005):
+            if pickup_points.in_range(p.pickup_point, loc.lat, loc.long):
                 return 'IN RANGE'
             else:
                 return 'OUT OF RANGE'
@@ -90,130 +102,258 @@ async def get_shipment_number_from_button(event):
     return shipment_number
 
 
-async def send_pcg(event: NewMessage, inp: Inpost, phone_number: int, parcel_type: ParcelType):
-    package: Parcel = await inp.get_parcel(shipment_number=event.text.strip(),
-                                           parcel_type=parcel_type,
-                                           parse=True)
-    with database.db_session:
-        if package.is_multicompartment:
-            packages: List[Parcel] = await inp.get_multi_compartment(multi_uuid=package.multi_compartment.uuid,
-                                                                     parse=True)
-            package = next((parcel for parcel in packages if parcel.is_main_multicompartment), None)
-            other = '\n'.join(f'📤 **Sender:** `{p.sender.sender_name}`\n'
-                              f'📦 **Shipment number:** `{p.shipment_number}`' for p in packages if
-                              not p.is_main_multicompartment)
+def parse_parcel(raw: dict, parcel_type: ParcelType) -> Parcel | SentParcel | ReturnParcel:
+    match parcel_type:
+        case ParcelType.SENT:
+            return SentParcel(raw, logging.getLogger('Inpost'))
+        case ParcelType.RETURNS:
+            return ReturnParcel(raw, logging.getLogger('Inpost'))
+        case _:
+            return Parcel(raw, logging.getLogger('Inpost'))
 
-            message = multicompartment_message_builder(amount=len(packages), package=package, other=other)
 
-        elif package.status == ParcelStatus.DELIVERED:
-            message = delivered_message_builder(package=package)
-        else:
-            message = compartment_message_builder(package=package)
-
-        if User.get(userid=event.sender.id).data_collecting_consent:
-            to_log = await inp.get_parcel(
-                shipment_number=package.shipment_number, parcel_type=parcel_type, parse=False)
-
-            database.add_parcel(event=event, phone_number=phone_number, ptype=parcel_type, parcel=to_log)
-
-        match package.status:
-            case ParcelStatus.READY_TO_PICKUP | ParcelStatus.STACK_IN_BOX_MACHINE:
-                await event.reply(message,
-                                  buttons=[
-                                      [Button.inline('Open Code'), Button.inline('QR Code')],
-                                      [Button.inline('Details'), Button.inline('Open Compartment')],
-                                      [Button.inline(
-                                          'Share')]] if package.operations.can_share_parcel and package.ownership_status == 'OWN' else [
-                                      [Button.inline('Open Code'), Button.inline('QR Code')],
-                                      [Button.inline('Details'), Button.inline('Open Compartment')]])
-            case _:
-                await event.reply(message,
-                                  buttons=[Button.inline('Details'),
-                                           Button.inline(
-                                               'Share')] if package.operations.can_share_parcel and package.ownership_status == 'OWN' else [
-                                      Button.inline('Details')])
-
-
-async def send_pcgs(event, inp, status, phone_number, parcel_type):
-    packages: List[Parcel] = await inp.get_parcels(status=status, parcel_type=parcel_type, parse=True)
-    exclude = []
-    if len(packages) > 0:
-        for package in packages:
-            if package.shipment_number in exclude:
-                continue
-
-            if package.is_multicompartment and not package.is_main_multicompartment:
-                exclude.append(package.shipment_number)
-                continue
-
-            elif package.is_main_multicompartment:
-                packages: List[Parcel] = await inp.get_multi_compartment(multi_uuid=package.multi_compartment.uuid,
-                                                                         parse=True)
-                package = next((parcel for parcel in packages if parcel.is_main_multicompartment), None)
-                other = '\n'.join(f'📤 **Sender:** `{p.sender.sender_name}`\n'
-                                  f'📦 **Shipment number:** `{p.shipment_number}\n`' for p in packages if
-                                  not p.is_main_multicompartment)
-
-                message = multicompartment_message_builder(amount=len(packages), package=package, other=other)
-
-            elif package.shipment_type == ParcelShipmentType.courier:
-                message = delivered_message_builder(package=package)
+def cache_parcels(inp: Inpost, parcels: List[Tuple[Parcel, dict]], parcel_type: ParcelType):
+    for parcel, raw in parcels:
+        parcel_cache.put(phone_number=inp.phone_number, shipment_number=parcel.shipment_number,
+                         parcel_type=parcel_type, status=parcel.status, raw=raw)
+        pickup_points.add_raw(raw.get('pickUpPoint'))
+
+
+def parcel_summary(package: Parcel, group_size: int | None) -> str:
+    expiry = package.expiry_date.timestamp() if package.expiry_date is not None else None
+    return fragment_cache.render(('summary', *parcel_version(package), expiry, group_size),
+                                 lambda: parcel_summary_builder(package=package, group_size=group_size))
+
+
+def parcel_events(parcel: Parcel) -> str:
+    return fragment_cache.render(('events', *parcel_version(parcel)), lambda: events_builder(parcel=parcel))
+
+
+@traced
+async def get_parcel_with_raw(inp: Inpost, shipment_number: int | str, parcel_type: ParcelType = ParcelType.TRACKED) \
+        -> Tuple[Parcel | SentParcel | ReturnParcel, dict]:
+    if (raw := parcel_cache.get(phone_number=inp.phone_number, shipment_number=shipment_number,
+                                parcel_type=parcel_type)) is not None:
+        return parse_parcel(raw, parcel_type), raw
+
+    raw: dict = await inpost_calls.do(
+        key=(inp.phone_number, 'get_parcel', str(shipment_number), parcel_type.name),
+        call=lambda: inp.get_parcel(shipment_number=shipment_number, parcel_type=parcel_type, parse=False))
+    parcel = parse_parcel(raw, parcel_type)
+    cache_parcels(inp=inp, parcels=[(parcel, raw)], parcel_type=parcel_type)
+
+    return parcel, raw
+
+
+@traced
+async def get_known_parcel(inp: Inpost, userid: int, shipment_number: str,
+                           parcel_type: ParcelType) -> Tuple[Parcel | SentParcel | ReturnParcel, dict]:
+    """Returns parcel from cache or latest stored snapshot, asks inpost only if it was never seen"""
+    if (raw := parcel_cache.get(phone_number=inp.phone_number, shipment_number=shipment_number,
+                                parcel_type=parcel_type)) is not None:
+        return parse_parcel(raw, parcel_type), raw
+
+    if (snapshot := await async_database.get_user_last_parcel_with_shipment_number(userid, shipment_number)) is not None:
+        return parse_parcel(snapshot.parcel, parcel_type), snapshot.parcel
+
+    return await get_parcel_with_raw(inp=inp, shipment_number=shipment_number, parcel_type=parcel_type)
+
+
+@traced
+async def get_parcels_with_raw(inp: Inpost, status, parcel_type: ParcelType) -> List[Tuple[Parcel, dict]]:
+    # statuses are unhashable enums, possibly in a list
+    status_key = tuple(s.name for s in status) if isinstance(status, list) else getattr(status, 'name', None)
+    raw: List[dict] = await inpost_calls.do(
+        key=(inp.phone_number, 'get_parcels', status_key, parcel_type.name),
+        call=lambda: inp.get_parcels(status=status, parcel_type=parcel_type, parse=False))
+    parcels = [(Parcel(data, logging.getLogger('Inpost')), data) for data in raw]
+    cache_parcels(inp=inp, parcels=parcels, parcel_type=parcel_type)
+
+    return parcels
+
+
+@traced
+async def get_multi_compartment_with_raw(inp: Inpost, multi_uuid: str) -> List[Tuple[Parcel, dict]]:
+    if (raw := parcel_cache.get_group(phone_number=inp.phone_number, multi_uuid=multi_uuid)) is not None:
+        return [(Parcel(data, logging.getLogger('Inpost')), data) for data in raw]
+
+    raw: List[dict] = await inpost_calls.do(key=(inp.phone_number, 'get_multi_compartment', multi_uuid),
+                                            call=lambda: inp.get_multi_compartment(multi_uuid=multi_uuid, parse=False))
+    parcels = [(Parcel(data, logging.getLogger('Inpost')), data) for data in raw]
+    cache_parcels(inp=inp, parcels=parcels, parcel_type=ParcelType.TRACKED)
+    parcel_cache.put_group(phone_number=inp.phone_number, multi_uuid=multi_uuid, parcels=parcels)
+
+    return parcels
 
-            else:
-                message = compartment_message_builder(package=package)
-
-            if package.status in (ParcelStatus.STACK_IN_BOX_MACHINE, ParcelStatus.STACK_IN_CUSTOMER_SERVICE_POINT):
-                message = f'⚠️ **PARCEL IS IN SUBSTITUTIONARY PICK UP POINT!** ⚠\n️\n' + message
-
-            if database.get_user_consent(userid=event.sender.id):
-                to_log = await inp.get_parcel(
-                    shipment_number=package.shipment_number, parcel_type=parcel_type, parse=False)
-
-                database.add_parcel(event=event, phone_number=phone_number, ptype=parcel_type, parcel=to_log)
-
-            match package.status:
-                case ParcelStatus.READY_TO_PICKUP | ParcelStatus.STACK_IN_BOX_MACHINE | ParcelStatus.STACK_IN_CUSTOMER_SERVICE_POINT | ParcelStatus.PICKUP_REMINDER_SENT:
-                    await event.reply(message + f'\n🫳 **Pick up until:** '
-                                                f'`{package.expiry_date.to("local").format("DD.MM.YYYY HH:mm")}`',
-                                      buttons=[
-                                          [Button.inline('Open Code'), Button.inline('QR Code')],
-                                          [Button.inline('Details'), Button.inline('Open Compartment')],
-                                          [Button.inline(
-                                              'Share')]] if package.operations.can_share_parcel and package.ownership_status == ParcelOwnership.OWN else
-                                      [[Button.inline('Open Code'), Button.inline('QR Code')],
-                                       [Button.inline('Details'), Button.inline('Open Compartment')]]
-                                      )
-                case _:
-                    await event.reply(message,
-                                      buttons=[Button.inline('Details'),
-                                               Button.inline(
-                                                   'Share')] if package.operations.can_share_parcel and package.ownership_status == 'OWN' else [
-                                          Button.inline('Details')])
 
+@traced
+def parcel_buttons(package: Parcel, parcel_type: ParcelType, phone_number: int | str) -> List[List[Button]]:
+    def button(text: str, action: ParcelAction) -> Button:
+        return Button.inline(text, encode_parcel_callback(action=action, parcel_type=parcel_type,
+                                                          phone_number=phone_number,
+                                                          shipment_number=package.shipment_number))
+
+    can_share = package.operations.can_share_parcel and package.ownership_status == ParcelOwnership.OWN
+    match package.status:
+        case ParcelStatus.READY_TO_PICKUP | ParcelStatus.STACK_IN_BOX_MACHINE:
+            buttons = [[button('Open Code', ParcelAction.OPEN_CODE), button('QR Code', ParcelAction.QR_CODE)],
+                       [button('Details', ParcelAction.DETAILS),
+                        button('Open Compartment', ParcelAction.OPEN_COMPARTMENT)]]
+            if can_share:
+                buttons.append([button('Share', ParcelAction.SHARE)])
+        case _:
+            buttons = [[button('Details', ParcelAction.DETAILS)]]
+            if can_share:
+                buttons[0].append(button('Share', ParcelAction.SHARE))
+
+    return buttons
+
+
+@traced
+async def send_pcg(event: NewMessage, inp: Inpost, phone_number: int, parcel_type: ParcelType,
+                   shipment_number: str | None = None):
+    package, to_log = await get_parcel_with_raw(inp=inp, shipment_number=shipment_number or event.text.strip(),
+                                                parcel_type=parcel_type)
+    if package.is_multicompartment:
+        group = await get_multi_compartment_with_raw(inp=inp, multi_uuid=package.multi_compartment.uuid)
+        package, to_log = next(((parcel, raw) for parcel, raw in group if parcel.is_main_multicompartment),
+                               (None, None))
+        other = '\n'.join(f'📤 **Sender:** `{p.sender.sender_name}`\n'
+                          f'📦 **Shipment number:** `{p.shipment_number}`' for p, _ in group if
+                          not p.is_main_multicompartment)
+
+        message = multicompartment_message_builder(amount=len(group), package=package, other=other)
+
+    elif package.status == ParcelStatus.DELIVERED:
+        message = delivered_message_builder(package=package)
     else:
+        message = compartment_message_builder(package=package)
+
+    if await async_database.get_user_consent(userid=event.sender.id):
+        await async_database.add_parcel(event=event, phone_number=phone_number, ptype=parcel_type, parcel=to_log)
+
+    await outbox.reply(event, message, buttons=parcel_buttons(package=package, parcel_type=parcel_type,
+                                                              phone_number=phone_number))
+
+
+@traced
+async def get_multi_compartments_with_raw(inp: Inpost, multi_uuids: List[str],
+                                          max_concurrency: int = 5) -> Dict[str, List[Tuple[Parcel, dict]]]:
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def resolve(multi_uuid: str):
+        async with semaphore:
+            return await get_multi_compartment_with_raw(inp=inp, multi_uuid=multi_uuid)
+
+    multi_uuids = list(dict.fromkeys(multi_uuids))  # dedupe, keeping order
+    return dict(zip(multi_uuids, await asyncio.gather(*(resolve(multi_uuid) for multi_uuid in multi_uuids))))
+
+
+@traced
+def parcel_list_buttons(list_filter: str, parcel_type: ParcelType, phone_number: int | str,
+                        parcels: List[Tuple[int, Parcel]], page: int, pages: int) -> List[List[Button]]:
+    buttons = [[Button.inline(f'{index}', encode_parcel_callback(action=ParcelAction.SHOW, parcel_type=parcel_type,
+                                                                 phone_number=phone_number,
+                                                                 shipment_number=parcel.shipment_number))
+                for index, parcel in parcels]]
+
+    if pages > 1:
+        buttons.append([Button.inline('◀️', f'List:{list_filter}:{phone_number}:{(page - 1) % pages}'),
+                        Button.inline(f'{page + 1}/{pages}', f'List:{list_filter}:{phone_number}:{page}'),
+                        Button.inline('▶️', f'List:{list_filter}:{phone_number}:{(page + 1) % pages}')])
+
+    return buttons
+
+
+@traced
+async def send_pcgs(event, inp, list_filter, phone_number, page: int = 0, page_size: int = 5, edit: bool = False,
+                    multicompartment_concurrency: int = 5):
+    status, parcel_type = parcel_list_filters[list_filter]
+    packages = await get_parcels_with_raw(inp=inp, status=status, parcel_type=parcel_type)
+    # other parcels of multicompartment are listed inside its main parcel
+    listed = [package for package, _ in packages if not package.is_multicompartment or
+              package.is_main_multicompartment]
+
+    if len(listed) == 0:
         if isinstance(event, CallbackQuery.Event):
             await event.answer('No parcels with specified status!', alert=True)
         elif isinstance(event, NewMessage.Event):
-            await event.reply('No parcels with specified status!')
+            await outbox.reply(event, 'No parcels with specified status!')
+
+        return status
+
+    if await async_database.get_user_consent(userid=event.sender.id):
+        await async_database.add_parcels(userid=event.sender.id, phone_number=phone_number, ptype=parcel_type,
+                                         parcels=[raw for _, raw in packages])
+
+    pages = -(-len(listed) // page_size)
+    page = min(max(page, 0), pages - 1)
+    on_page = list(enumerate(listed[page * page_size:(page + 1) * page_size], start=page * page_size + 1))
+    groups = await get_multi_compartments_with_raw(
+        inp=inp, multi_uuids=[package.multi_compartment.uuid for _, package in on_page if
+                              package.is_main_multicompartment],
+        max_concurrency=multicompartment_concurrency)
+
+    message = parcel_list_message_builder(
+        list_filter=list_filter, page=page, pages=pages, amount=len(listed),
+        entries=[parcel_list_entry_builder(index=index, summary=parcel_summary(
+            package=package,
+            group_size=len(groups[package.multi_compartment.uuid]) if package.is_main_multicompartment else None))
+                 for index, package in on_page])
+    buttons = parcel_list_buttons(list_filter=list_filter, parcel_type=parcel_type, phone_number=phone_number,
+                                  parcels=on_page, page=page, pages=pages)
+
+    if edit:
+        try:
+            await outbox.edit(event, message, buttons=buttons)
+        except MessageNotModifiedError:  # refreshed page did not change
+            pass
+
+        await event.answer()
+    else:
+        await outbox.reply(event, message, buttons=buttons)
 
     return status
 
 
-async def send_qrc(event, parcel, inp):
+@traced
+async def send_qrc(event, parcel, inp, raw: dict):
     if parcel.status not in pending_statuses:
-        parcel: Parcel = await inp.get_parcel(shipment_number=parcel.shipment_number, parse=True)
+        parcel, raw = await get_parcel_with_raw(inp=inp, shipment_number=parcel.shipment_number)
 
     if parcel.status not in pending_statuses:
         await event.answer(f'Parcel not ready for pick up!\nStatus: {parcel.status.value}', alert=True)
         return
 
-    await event.reply(file=parcel.generate_qr_image)
+    if (qr_code := raw.get('qrCode')) is None:
+        await event.answer('This parcel has no QR code!', alert=True)
+        return
+
+    qr_hash = qr_code_hash(qr_code)
+    if (media := await async_database.get_qr_code_media(qr_hash=qr_hash)) is not None:
+        photo_id, access_hash, file_reference = media
+        try:
+            await outbox.reply(event, file=InputPhoto(id=photo_id, access_hash=access_hash, file_reference=file_reference))
+            return
+        except (FileReferenceExpiredError, MediaEmptyError):  # upload it once again below
+            await async_database.delete_qr_code_media(qr_hash=qr_hash)
+
+    if (image := qr_code_cache.get(qr_hash)) is None:
+        image = parcel.generate_qr_image.getvalue()
+        qr_code_cache.put(qr_hash, image)
+
+    message = await outbox.reply(event, file=BytesIO(image))
+    if message.photo is not None:
+        await async_database.set_qr_code_media(qr_hash=qr_hash, photo_id=message.photo.id,
+                                               access_hash=message.photo.access_hash,
+                                               file_reference=message.photo.file_reference)
 
 
 
+@traced
 async def show_oc(event, parcel, inp):
     if parcel.status not in pending_statuses:
-        parcel: Parcel = await inp.get_parcel(shipment_number=parcel.shipment_number, parse=True)
+        parcel, _ = await get_parcel_with_raw(inp=inp, shipment_number=parcel.shipment_number)
 
     if parcel.status not in pending_statuses:
         await event.answer(f'Parcel not ready for pick up!\nStatus: {parcel.status.value}', alert=True)
@@ -221,49 +361,48 @@ async def show_oc(event, parcel, inp):
     await event.answer(f'This parcel open code is: {parcel.open_code}', alert=True)
 
 
+@traced
 async def open_comp(event, inp, p: Parcel):
     if p.status not in pending_statuses:
-        p: Parcel = await inp.get_parcel(shipment_number=p.shipment_number, parse=True)
+        p, _ = await get_parcel_with_raw(inp=inp, shipment_number=p.shipment_number)
 
     p_ = await inp.collect(parcel_obj=p)
+    parcel_cache.invalidate(phone_number=inp.phone_number, shipment_number=p.shipment_number)
     if p_ is not None:
-        to_log = await inp.get_parcel(shipment_number=p.shipment_number,
-                                      parcel_type=ParcelType.TRACKED,
-                                      parse=False)
+        _, to_log = await get_parcel_with_raw(inp=inp, shipment_number=p.shipment_number,
+                                              parcel_type=ParcelType.TRACKED)
 
-        database.add_parcel(event=event, phone_number=inp.phone_number, ptype=ParcelType.TRACKED, parcel=to_log)
+        await async_database.add_parcel(event=event, phone_number=inp.phone_number, ptype=ParcelType.TRACKED,
+                                        parcel=to_log)
 
         return p_
 
     return None
 
 
+@traced
 async def send_details(event, inp, parcel):
     if parcel.is_multicompartment:  # TODO: Add airsensor data
-        parcels = await inp.get_multi_compartment(multi_uuid=parcel.multi_compartment.uuid, parse=True)
+        parcels = await get_multi_compartment_with_raw(inp=inp, multi_uuid=parcel.multi_compartment.uuid)
         message = ''
 
-        for p in parcels:
+        for p, _ in parcels:
             message = message + f'**Sender:** {p.sender}\n'
-            events = "\n".join(
-                f'{status.date.to("local").format("DD.MM.YYYY HH:mm"):>22}: {status.name.value}' for status in
-                p.event_log)
+            events = parcel_events(parcel=p)
             if p.status == ParcelStatus.READY_TO_PICKUP or p.status == ParcelStatus.STACK_IN_BOX_MACHINE:
                 message = message + details_message_builder(parcel=p, events=events)
 
             elif p.status == ParcelStatus.DELIVERED:
-                message = message + f'**Stored**: {p.stored_date.to("local").format("DD.MM.YYYY HH:mm")}\n' \
+                message = message + f'**Stored**: {local_datetime(p.stored_date)}\n' \
                                     f'**Events**:\n{events}\n\n'
             else:
                 message = message + f'**Events**:\n{events}\n\n'
 
-        await event.reply(message)
+        await outbox.reply(event, message)
     else:
-        events = "\n".join(
-            f'{status.date.to("local").format("DD.MM.YYYY HH:mm"):>22}: {status.name.value}' for status in
-            parcel.event_log)
+        events = parcel_events(parcel=parcel)
         air_quality = None
-        if database.get_user_air_quality(userid=event.sender.id) and parcel.pickup_point.air_sensor:
+        if await async_database.get_user_air_quality(userid=event.sender.id) and parcel.pickup_point.air_sensor:
             air_quality = f'Air quality: {parcel.pickup_point.air_sensor_data.air_quality}\n' \
                           f'Temperature: {parcel.pickup_point.air_sensor_data.temperature}\n' \
                           f'Humidity: {parcel.pickup_point.air_sensor_data.humidity}\n' \
@@ -272,50 +411,52 @@ async def send_details(event, inp, parcel):
                           f'Temperature: {parcel.pickup_point.air_sensor_data.pm10_value}, {parcel.pickup_point.air_sensor_data.pm10_percent}%\n'
 
         if parcel.status == ParcelStatus.READY_TO_PICKUP or parcel.status == ParcelStatus.STACK_IN_BOX_MACHINE:
-            await event.reply(ready_to_pickup_message_builder(parcel=parcel, events=events, air_quality=air_quality))
+            await outbox.reply(event, ready_to_pickup_message_builder(parcel=parcel, events=events, air_quality=air_quality))
         elif parcel.status == ParcelStatus.DELIVERED:
-            await event.reply(f'**Picked up**: {parcel.pickup_date.to("local").format("DD.MM.YYYY HH:mm")}\n'
-                              f'**Events**:\n{events}')
+            await outbox.reply(event, f'**Picked up**: {local_datetime(parcel.pickup_date)}\n'
+                               f'**Events**:\n{events}')
         else:
-            await event.reply(f'**Events**:\n{events}')
+            await outbox.reply(event, f'**Events**:\n{events}')
 
     return
 
 
+@traced
 async def share_parcel(event, convo, inp, shipment_number):
-    friends = await inp.get_parcel_friends(shipment_number=shipment_number, parse=True)
+    friends = await inpost_calls.do(key=(inp.phone_number, 'get_parcel_friends', str(shipment_number)),
+                                    call=lambda: inp.get_parcel_friends(shipment_number=shipment_number, parse=True))
 
     if not await is_parcel_owner(inp=inp,
                                  shipment_number=shipment_number,
                                  parcel_type=ParcelType.TRACKED):
-        await event.reply('This parcel does not belong to you, cannot share it')
+        await outbox.reply(event, 'This parcel does not belong to you, cannot share it')
         return
 
     if len(friends['friends']) == 0:
-        await event.reply('This parcel has no people it can be shared with!')
+        await outbox.reply(event, 'This parcel has no people it can be shared with!')
         return
 
     if isinstance(event, CallbackQuery.Event):
         for f in friends['friends']:
-            await convo.send_message(f'**Name**: {f.name}\n'
-                                     f'**Phone number**: {f.phone_number}',
-                                     buttons=[Button.inline('Dispatch')])
+            await outbox.send_message(convo, f'**Name**: {f.name}\n'
+                                      f'**Phone number**: {f.phone_number}',
+                                      buttons=[Button.inline('Dispatch')])
 
-        await event.reply('Fine, now pick a friend to share parcel to and press `Dispatch` button')
+        await outbox.reply(event, 'Fine, now pick a friend to share parcel to and press `Dispatch` button')
         friend = await convo.wait_event(CallbackQuery(pattern='Dispatch'), timeout=30)
         friend_event = friend
         friend = await friend.get_message()
 
     elif isinstance(event, NewMessage.Event):
         for f in friends['friends']:
-            await convo.send_message(f'**Name**: {f.name}\n'
-                                     f'**Phone number**: {f.phone_number}')
+            await outbox.send_message(convo, f'**Name**: {f.name}\n'
+                                      f'**Phone number**: {f.phone_number}')
 
-        await convo.send_message('Fine, now pick a friend to share parcel to and '
-                                 'send a reply to him/her with `/dispatch`')
+        await outbox.send_message(convo, 'Fine, now pick a friend to share parcel to and '
+                                  'send a reply to him/her with `/dispatch`')
         friend = await convo.get_response(timeout=30)
         if not friend.is_reply:
-            await friend.reply(
+            await outbox.reply(friend,
                 'You must reply to message with desired friend, start sharing again!')
             return
 
@@ -327,72 +468,78 @@ async def share_parcel(event, convo, inp, shipment_number):
 
     uuid = (next((f for f in friends['friends'] if
                   (f.name == friend[0] and f.phone_number == friend[1])))).uuid
-    if await inp.share_parcel(uuid=uuid, shipment_number=shipment_number):
-        await friend_event.reply('Parcel shared!')
+    shared = await inp.share_parcel(uuid=uuid, shipment_number=shipment_number)
+    parcel_cache.invalidate(phone_number=inp.phone_number, shipment_number=shipment_number)
+    if shared:
+        await outbox.reply(friend_event, 'Parcel shared!')
     else:
-        await friend_event.reply('Not shared, try again!')
+        await outbox.reply(friend_event, 'Not shared, try again!')
 
 
+@traced
 async def open_compartment(event, convo, inp, parcel, parcel_type):
     # TODO: Add database check if user consent if parcel
     #  is ParcelType.TRACKED using /open instead of button
     # TODO: Add database parcel get if user consent
-    p: Parcel = await inp.get_parcel(shipment_number=parcel.shipment_number, parcel_type=parcel_type,
-                                     parse=True)
-    if (database.get_user_geocheck(userid=event.sender.id) or
-            database.get_user_default_parcel_machine(userid=event.sender.id) != p.pickup_point.name):
-        user_location = database.get_user_location(userid=event.sender.id)
+    p, _ = await get_parcel_with_raw(inp=inp, shipment_number=parcel.shipment_number, parcel_type=parcel_type)
+    if (await async_database.get_user_geocheck(userid=event.sender.id) or
+            await async_database.get_user_default_parcel_machine(userid=event.sender.id) != p.pickup_point.name):
+        user_location = await async_database.get_user_location(userid=event.sender.id)
         if any(loc_val is None for loc_val in user_location.values()):
             check_location = True
         else:
             check_location = (datetime.datetime.now() - user_location['location_time']) > datetime.timedelta(minutes=2)
 
         if check_location:
-            await convo.send_message(
+            await outbox.send_message(convo,
                 'Please share your location so I can check '
                 'whether you are near parcel machine or not.',
                 buttons=[Button.request_location('Confirm localization')])
 
             geo = await convo.get_response(timeout=30)
             if not geo.geo:
-                await convo.send_message(
+                await outbox.send_message(convo,
                     'Your message does not contain geolocation, start opening again!',
                     buttons=Button.clear())
                 convo.cancel()
                 return
 
-            database.update_user_location(userid=event.sender.id,
-                                          lat=geo.geo.lat,
-                                          long=geo.geo.long,
-                                          loc_time=datetime.datetime.now()
-                                          )
+            await async_database.update_user_location(userid=event.sender.id,
+                                                      lat=geo.geo.lat,
+                                                      long=geo.geo.long,
+                                                      loc_time=datetime.datetime.now()
+                                                      )
 
             status = await confirm_location(event=geo, parcel_obj=p)
 
             match status:
                 case 'IN RANGE':
-                    await convo.send_message('You are in range. Are you sure to open?',
-                                             buttons=[Button.inline('Yes!'),
-                                                      Button.inline('Hell no!')])
+                    await outbox.send_message(convo, 'You are in range. Are you sure to open?',
+                                              buttons=[Button.inline('Yes!'),
+                                                       Button.inline('Hell no!')])
                 case 'OUT OF RANGE':
-                    await convo.send_message(out_of_range_message_builder(parcel=p),
-                                             buttons=[Button.inline('Yes!'),
-                                                      Button.inline('Hell no!')])
+                    nearest = pickup_points.nearest(geo.geo.lat, geo.geo.long)
+                    await outbox.send_message(convo, out_of_range_message_builder(
+                        parcel=p, nearest=nearest[1].name if nearest is not None else None,
+                        distance=haversine(geo.geo.lat, geo.geo.long, p.pickup_point.latitude,
+                                           p.pickup_point.longitude)),
+                                              buttons=[Button.inline('Yes!'),
+                                                       Button.inline('Hell no!')])
                 case 'NOT READY':
-                    await convo.send_message(f'Parcel is not ready for pick up! Status: {p.status}')
+                    await outbox.send_message(convo, f'Parcel is not ready for pick up! Status: {p.status}')
                 case 'DELIVERED':
-                    await convo.send_message('Parcel has been already delivered!')
+                    await outbox.send_message(convo, 'Parcel has been already delivered!')
                     return
 
         else:
-            await convo.send_message(
+            await outbox.send_message(convo,
                 f'Less than 2 minutes have passed since the last compartment opening, '
                 f'you were in range of **{p.pickup_point.name}** parcel machine, '
                 f'assuming you still are and skipping location verification.'
                 f'\nAre you sure to open?',
                 buttons=[Button.inline('Yes!'), Button.inline('Hell no!')])
     else:
-        await convo.send_message(
+        await outbox.send_message(convo,
             f'You have location checking off or this parcel is in default parcel '
             f'machine, skipping! You can turn location checking on by sending:\n '
             f'`/set_geocheck {inp.phone_number} On`!\n\nAre you sure to open?',
@@ -403,15 +550,15 @@ async def open_compartment(event, convo, inp, parcel, parcel_type):
     match decision.data:
         case b'Yes!':
             if p_ := await open_comp(event, inp, p):
-                await decision.reply(open_comp_message_builder(parcel=p_), buttons=Button.clear())
+                await outbox.reply(decision, open_comp_message_builder(parcel=p_), buttons=Button.clear())
         case b'Hell no!':
-            await decision.reply('Fine, compartment remains closed!', buttons=Button.clear())
+            await outbox.reply(decision, 'Fine, compartment remains closed!', buttons=Button.clear())
         case _:
-            await decision.reply('Unrecognizable decision made, please start opening compartment '
-                                 'again!')
+            await outbox.reply(decision, 'Unrecognizable decision made, please start opening compartment '
+                               'again!')
 
 
 async def is_parcel_owner(inp, shipment_number, parcel_type) -> bool:
-    parcel = await inp.get_parcel(shipment_number=shipment_number, parcel_type=parcel_type, parse=True)
+    parcel, _ = await get_parcel_with_raw(inp=inp, shipment_number=shipment_number, parcel_type=parcel_type)
 
     return parcel.ownership_status == ParcelOwnership.OWN